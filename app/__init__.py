@@ -1,3 +1,4 @@
+import atexit
 import logging
 from logging.handlers import RotatingFileHandler
 import os
@@ -10,6 +11,8 @@ from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel
 from elasticsearch import Elasticsearch
+from redis import Redis
+import rq
 
 
 db = SQLAlchemy()
@@ -25,6 +28,10 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    from app.models import User
+    # Fail at startup rather than at the first login
+    User.validate_password_policy(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+
     db.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
@@ -36,6 +43,70 @@ def create_app(config_class=Config):
     if app.config['ELASTICSEARCH_URL']:
         app.elasticsearch = Elasticsearch(app.config['ELASTICSEARCH_URL'])
 
+    from app.search import ElasticsearchBackend, DatabaseBackend
+    app.search = None
+    if app.config['SEARCH_BACKEND'] == 'elasticsearch':
+        app.search = ElasticsearchBackend()
+    elif app.config['SEARCH_BACKEND'] == 'database' and DatabaseBackend.supports(app.config['SQLALCHEMY_DATABASE_URI']):
+        app.search = DatabaseBackend()
+
+    app.redis = None
+    app.task_queue = None
+    if app.config['REDIS_URL']:
+        app.redis = Redis.from_url(app.config['REDIS_URL'])
+        app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+
+    from app.translate import TranslationCache
+    app.translation_cache = TranslationCache(app.config['TRANSLATION_CACHE_SIZE'], app.config['TRANSLATION_CACHE_TTL'],
+                                             redis=app.redis)
+
+    from app.pubsub import MemoryBroker, RedisBroker
+    app.notification_broker = RedisBroker(app.redis) if app.redis else MemoryBroker()
+    if app.config['NOTIFICATIONS_PUSH'] and not app.redis:
+        # The in-process broker cannot reach the subscribers of the other processes
+        raise RuntimeError('NOTIFICATIONS_PUSH needs REDIS_URL')
+
+    from app.api.auth import MemoryTokenCache, RedisTokenCache
+    app.token_cache = None
+    if app.config['TOKEN_CACHE_BACKEND'] == 'memory':
+        app.token_cache = MemoryTokenCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+    elif app.config['TOKEN_CACHE_BACKEND'] == 'redis':
+        if not app.redis:
+            raise RuntimeError('TOKEN_CACHE_BACKEND=redis needs REDIS_URL')
+        app.token_cache = RedisTokenCache(app.redis, app.config['TOKEN_CACHE_TTL'])
+
+    from app.activity import MemoryActivity, RedisActivity, flush_on_exit
+    if app.config['LAST_SEEN_BACKEND'] == 'redis':
+        if not app.redis:
+            raise RuntimeError('LAST_SEEN_BACKEND=redis needs REDIS_URL')
+        app.activity = RedisActivity(app.redis)
+    else:
+        app.activity = MemoryActivity()
+    if not app.testing:
+        atexit.register(flush_on_exit, app)
+
+    from app.timeline import MemoryTimeline, RedisTimeline
+    app.timeline = None
+    if app.config['TIMELINE_BACKEND'] == 'memory':
+        app.timeline = MemoryTimeline()
+    elif app.config['TIMELINE_BACKEND'] == 'redis':
+        if not app.redis:
+            raise RuntimeError('TIMELINE_BACKEND=redis needs REDIS_URL')
+        app.timeline = RedisTimeline(app.redis)
+
+    from app.cache import MemoryResponseCache, RedisResponseCache
+    app.response_cache = None
+    if app.config['RESPONSE_CACHE_BACKEND'] == 'memory':
+        app.response_cache = MemoryResponseCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+    elif app.config['RESPONSE_CACHE_BACKEND'] == 'redis':
+        if not app.redis:
+            raise RuntimeError('RESPONSE_CACHE_BACKEND=redis needs REDIS_URL')
+        app.response_cache = RedisResponseCache(app.redis, app.config['RESPONSE_CACHE_TTL'])
+
+    if app.config['INSTRUMENTATION']:
+        from app.instrumentation import instrument
+        instrument(app)
+
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
 
@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+from flask import current_app
+from app import db
+from app.models import User
+
+
+class MemoryActivity(object):
+    """Buffers the last activity time of users in process memory until it is flushed."""
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = Lock()
+        self.last_flush = time()
+
+    def record(self, user_id, when):
+        with self.lock:
+            self.pending[user_id] = when
+
+    def get(self, user_id):
+        return self.pending.get(user_id)
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def restore(self, pending):
+        """Put back drained activity that could not be written, unless newer activity was recorded since."""
+        with self.lock:
+            for user_id, when in pending.items():
+                self.pending.setdefault(user_id, when)
+
+
+class RedisActivity(object):
+    """Buffers the last activity time of users in a Redis hash shared by all processes."""
+    key = 'last_seen'
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.last_flush = time()
+
+    def record(self, user_id, when):
+        self.redis.hset(self.key, user_id, when.isoformat())
+
+    def get(self, user_id):
+        value = self.redis.hget(self.key, user_id)
+        return datetime.fromisoformat(value.decode('UTF-8')) if value else None
+
+    def drain(self):
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.key)
+        pipe.delete(self.key)
+        pending = pipe.execute()[0]
+        return {int(user_id): datetime.fromisoformat(when.decode('UTF-8')) for user_id, when in pending.items()}
+
+    def restore(self, pending):
+        pipe = self.redis.pipeline()
+        for user_id, when in pending.items():
+            pipe.hsetnx(self.key, user_id, when.isoformat())
+        pipe.execute()
+
+
+def record_activity(user):
+    """Note that the user is active now.
+
+    Activity is only buffered when the stored last_seen is older than LAST_SEEN_THRESHOLD, and the
+    buffer is written to the database at most every LAST_SEEN_FLUSH_INTERVAL seconds."""
+    now = datetime.utcnow()
+    if user.last_seen is None or now - user.last_seen >= timedelta(seconds=current_app.config['LAST_SEEN_THRESHOLD']):
+        current_app.activity.record(user.id, now)
+    if time() - current_app.activity.last_flush >= current_app.config['LAST_SEEN_FLUSH_INTERVAL']:
+        try:
+            flush_activity()
+        except Exception:
+            # The activity is kept for the next flush, the request goes on
+            current_app.logger.exception('Could not flush the last seen times')
+
+
+def flush_activity():
+    """Write the buffered activity to the database with one bulk UPDATE and return the number of users.
+
+    If the write fails the activity is buffered again for the next flush and the error is raised."""
+    current_app.activity.last_flush = time()
+    pending = current_app.activity.drain()
+    if not pending:
+        return 0
+    statement = User.__table__.update().where(User.id == db.bindparam('user_id'))\
+        .values(last_seen=db.bindparam('when'))
+    try:
+        db.session.execute(statement, [{'user_id': user_id, 'when': when} for user_id, when in pending.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        current_app.activity.restore(pending)
+        raise
+    return len(pending)
+
+
+def flush_on_exit(app):
+    with app.app_context():
+        try:
+            flush_activity()
+        except Exception:
+            app.logger.exception('Could not flush the last seen times')
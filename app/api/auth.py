@@ -1,5 +1,10 @@
-from flask import g
+from datetime import datetime
+from hashlib import sha256
+from threading import Lock
+from cachetools import TTLCache
+from flask import g, current_app
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
+from werkzeug.local import LocalProxy
 from app.models import User
 from app.api.errors import error_response
 
@@ -8,6 +13,76 @@ basic_auth = HTTPBasicAuth()
 token_auth = HTTPTokenAuth()
 
 
+class MemoryTokenCache(object):
+    """Bounded in-process map of token to (user_id, expiration).
+
+    Revocations only reach the process that made them, other processes forget the token after ttl
+    seconds, so keep ttl short or use RedisTokenCache when running several processes."""
+
+    def __init__(self, maxsize, ttl):
+        self.entries = TTLCache(maxsize, ttl)
+        self.lock = Lock()
+
+    def get(self, token):
+        with self.lock:
+            return self.entries.get(token)
+
+    def set(self, token, user_id, expiration):
+        with self.lock:
+            self.entries[token] = (user_id, expiration)
+
+    def delete(self, token):
+        with self.lock:
+            self.entries.pop(token, None)
+
+
+class RedisTokenCache(object):
+    """Map of token to (user_id, expiration) shared by all processes through Redis."""
+
+    def __init__(self, redis, ttl):
+        self.redis = redis
+        self.ttl = ttl
+
+    @staticmethod
+    def key(token):
+        # Tokens are credentials, only their digest is stored
+        return 'token:' + sha256(token.encode('UTF-8')).hexdigest()
+
+    def get(self, token):
+        value = self.redis.get(self.key(token))
+        if value is None:
+            return None
+        user_id, expiration = value.decode('UTF-8').split(' ')
+        return int(user_id), datetime.fromisoformat(expiration)
+
+    def set(self, token, user_id, expiration):
+        ttl = min(self.ttl, int((expiration - datetime.utcnow()).total_seconds()))
+        if ttl > 0:
+            self.redis.setex(self.key(token), ttl, f'{user_id} {expiration.isoformat()}')
+
+    def delete(self, token):
+        self.redis.delete(self.key(token))
+
+
+def token_user_id(token):
+    """Return the id of the user that owns a valid token, only querying the database on a cache miss."""
+    cache = current_app.token_cache
+    entry = cache.get(token) if cache else None
+    if entry is None:
+        user = User.check_token(token)
+        if user is None:
+            return None
+        entry = (user.id, user.token_expiration)
+        if cache:
+            cache.set(token, *entry)
+    user_id, expiration = entry
+    if expiration < datetime.utcnow():
+        if cache:
+            cache.delete(token)
+        return None
+    return user_id
+
+
 @basic_auth.verify_password
 def verify_password(username, password):
     user = User.query.filter_by(username=username).first()
@@ -24,8 +99,11 @@ def basic_auth_error():
 
 @token_auth.verify_token
 def verify_token(token):
-    g.current_user = User.check_token(token) if token else None
-    return g.current_user is not None
+    user_id = token_user_id(token) if token else None
+    g.current_user_id = user_id
+    # The user is only loaded if the endpoint uses it, the session identity map keeps it loaded once
+    g.current_user = LocalProxy(lambda: User.query.get(user_id)) if user_id is not None else None
+    return user_id is not None
 
 
 @token_auth.error_handler
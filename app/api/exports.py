@@ -0,0 +1,22 @@
+from flask import request, Response, stream_with_context
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.export import EXPORTS, ndjson, parse_since
+
+
+@bp.route('/export/<any(posts, users, follows):name>', methods=['GET'])
+@token_auth.login_required
+def export(name):
+    """Stream every post, user or follower edge as NDJSON, oldest first.
+
+    The optional since argument is an ISO 8601 UTC watermark, usually the timestamp of the last row
+    of the previous pull, and limits the export to the rows created or changed since then."""
+    since = None
+    if request.args.get('since'):
+        try:
+            since = parse_since(request.args['since'])
+        except ValueError:
+            return bad_request('since must be an ISO 8601 date and time')
+    rows = EXPORTS[name](since)
+    return Response(stream_with_context(ndjson(rows)), mimetype='application/x-ndjson')
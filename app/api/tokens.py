@@ -1,4 +1,4 @@
-from flask import jsonify, g
+from flask import jsonify, g, current_app
 from app import db
 from app.api import bp
 from app.api.auth import basic_auth, token_auth
@@ -9,6 +9,8 @@ from app.api.auth import basic_auth, token_auth
 def get_token():
     token = g.current_user.get_token()
     db.session.commit()
+    if current_app.token_cache:
+        current_app.token_cache.set(token, g.current_user.id, g.current_user.token_expiration)
     return jsonify({'token': token})
 
 
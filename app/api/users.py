@@ -1,41 +1,97 @@
-from flask import jsonify, request, url_for, g, abort
+import json
+from hashlib import md5
+from flask import jsonify, request, url_for, g, abort, Response
+from werkzeug.http import is_resource_modified
 from app import db
 from app.models import User
 from app.api import bp
 from app.api.errors import bad_request
 from app.api.auth import token_auth
+from app.pagination import paginate, pagination_args
+from app.cache import invalidate
+
+
+def conditional_response(etag, build, last_modified=None):
+    """Answer a conditional request with 304 when the validators match, calling build for the payload otherwise."""
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = jsonify(build())
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def fields_arg():
+    """Read the fields argument, a comma separated list of the User.to_dict fields to return."""
+    if not request.args.get('fields'):
+        return None
+    fields = set(request.args['fields'].split(','))
+    unknown = fields.difference(User.__api_fields__)
+    if unknown:
+        abort(bad_request(f'unknown fields: {", ".join(sorted(unknown))}'))
+    return fields
+
+
+def ids_arg():
+    try:
+        ids = [int(id) for id in request.args['ids'].split(',') if id]
+    except ValueError:
+        abort(bad_request('ids must be a comma separated list of user ids'))
+    if len(ids) > 100:
+        abort(bad_request('at most 100 ids can be requested at once'))
+    return ids
+
+
+def collection_response(query, per_page, endpoint, **kwargs):
+    args = pagination_args()
+    fields = fields_arg()
+    resources = paginate(query, User, per_page, **args)
+    return conditional_response(User.collection_etag(resources), lambda: User.to_collection_dict(
+        query, per_page, endpoint, resources=resources, fields=fields, **args, **kwargs))
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    fields = fields_arg()
+    user = User.query.get_or_404(id)
+    return conditional_response(user.etag(), lambda: user.to_dict(fields=fields), user.get_last_modified())
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
+    if 'ids' in request.args:
+        return get_users_by_id(ids_arg())
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return jsonify(User.to_collection_dict(User.query, page, per_page, 'api.get_users'))
+    return collection_response(User.query, per_page, 'api.get_users')
+
+
+def get_users_by_id(ids):
+    """Return the users with the given ids in the order requested, ids without a user are left out."""
+    fields = fields_arg()
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))} if ids else {}
+    items = [users[id] for id in ids if id in users]
+    etag = md5(json.dumps([item.etag() for item in items]).encode('UTF-8')).hexdigest()
+    return conditional_response(etag, lambda: {'items': [item.to_dict(fields=fields) for item in items]})
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return jsonify(User.to_collection_dict(user.followers, page, per_page, 'api.get_followers', id=id))
+    return collection_response(user.followers, per_page, 'api.get_followers', id=id)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return jsonify(User.to_collection_dict(user.followed, page, per_page, 'api.get_followed', id=id))
+    return collection_response(user.followed, per_page, 'api.get_followed', id=id)
 
 
 @bp.route('/users', methods=['POST'])
@@ -60,7 +116,7 @@ def create_user():
 @bp.route('/users/<int:id>', methods=['PUT'])
 @token_auth.login_required
 def update_user(id):
-    if g.current_user.id != id:
+    if g.current_user_id != id:
         abort(403)
     data = request.get_json() or {}
     user = User.query.get_or_404(id)
@@ -68,7 +124,9 @@ def update_user(id):
         return bad_request('please use a different user name')
     if 'email' in data and data['email'] != user.email and User.query.filter_by(email=data['email']).first():
         return bad_request('please use a different user name')
+    username = user.username
     user.from_dict(data, new_user=False)
     db.session.add(user)
     db.session.commit()
+    invalidate('explore', f'user:{username}', f'user:{user.username}')
     return jsonify(user.to_dict())
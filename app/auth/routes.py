@@ -21,6 +21,8 @@ def login():
     if user is None or not user.check_password(form.password.data):
         flash('Invalid username or password')
         return redirect(url_for('auth.login'))
+    # Saves the password hash if check_password upgraded it
+    db.session.commit()
     login_user(user=user, remember=form.remember_me.data)
     next_page = request.args.get('next')
     if not next_page or url_parse(next_page).netloc != '':
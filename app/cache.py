@@ -0,0 +1,113 @@
+import json
+from datetime import datetime
+from functools import wraps
+from hashlib import md5, sha256
+from threading import Lock
+from cachetools import TTLCache
+from flask import current_app, request, session, g, make_response, Response
+from flask_login import current_user
+
+
+class MemoryResponseCache(object):
+    """Bounded in-process cache of rendered responses.
+
+    Invalidations only reach the process that made them, other processes serve their copy until it
+    expires after ttl seconds, so only use it with a single process. Several processes need
+    RedisResponseCache."""
+
+    def __init__(self, maxsize, ttl):
+        self.entries = TTLCache(maxsize, ttl)
+        self.tags = {}
+        self.lock = Lock()
+
+    def versions(self, tags):
+        with self.lock:
+            return [self.tags.get(tag, 0) for tag in tags]
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.tags[tag] = self.tags.get(tag, 0) + 1
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+
+
+class RedisResponseCache(object):
+    """Cache of rendered responses shared by all processes through Redis."""
+
+    def __init__(self, redis, ttl):
+        self.redis = redis
+        self.ttl = ttl
+
+    def versions(self, tags):
+        return [int(version or 0) for version in self.redis.mget([f'response-tag:{tag}' for tag in tags])]
+
+    def invalidate(self, tags):
+        pipe = self.redis.pipeline()
+        for tag in tags:
+            pipe.incr(f'response-tag:{tag}')
+        pipe.execute()
+
+    def get(self, key):
+        value = self.redis.get(key)
+        if value is None:
+            return None
+        entry = json.loads(value.decode('UTF-8'))
+        entry['last_modified'] = datetime.utcfromtimestamp(entry['last_modified'])
+        return entry
+
+    def set(self, key, entry):
+        value = dict(entry, last_modified=(entry['last_modified'] - datetime(1970, 1, 1)).total_seconds())
+        self.redis.setex(key, self.ttl, json.dumps(value))
+
+
+def _key(tags):
+    """Key the response of the current request on its route, arguments, locale and tag versions."""
+    versions = current_app.response_cache.versions(tags)
+    args = sorted(request.args.items(multi=True))
+    data = json.dumps([request.endpoint, request.view_args, args, g.locale, list(zip(tags, versions))],
+                      sort_keys=True)
+    return f'response:{request.endpoint}:{sha256(data.encode("UTF-8")).hexdigest()}'
+
+
+def cached_response(*tags):
+    """Serve the view from the response cache to anonymous visitors.
+
+    tags are format strings filled in with the view arguments, e.g. 'user:{username}'. Passing a tag
+    to invalidate() makes every cached response carrying it stale. Cached responses carry an ETag and
+    Last-Modified so browsers can revalidate them with a 304."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            cache = current_app.response_cache
+            if cache is None or current_user.is_authenticated or request.method != 'GET' or '_flashes' in session:
+                return view(**kwargs)
+            key = _key([tag.format(**kwargs) for tag in tags])
+            entry = cache.get(key)
+            if entry is None:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200 or session.modified:
+                    return response
+                body = response.get_data(as_text=True)
+                entry = {'body': body, 'etag': md5(body.encode('UTF-8')).hexdigest(),
+                         'last_modified': datetime.utcnow().replace(microsecond=0)}
+                cache.set(key, entry)
+            response = Response(entry['body'], mimetype='text/html')
+            response.set_etag(entry['etag'])
+            response.last_modified = entry['last_modified']
+            response.vary.update(('Cookie', 'Accept-Language'))
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+def invalidate(*tags):
+    if current_app.response_cache is None:
+        return
+    current_app.response_cache.invalidate(tags)
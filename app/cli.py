@@ -0,0 +1,124 @@
+from time import time
+import click
+from app import db
+from app.models import User, Post, Notification
+from app.timeline import rebuild_timeline
+from app.export import EXPORTS, ndjson, parse_since
+from app.seed import SyntheticGraph, read_rows, import_rows, finish_import
+
+
+def register(app):
+    @app.cli.group()
+    def timeline():
+        """Home timeline store commands."""
+        pass
+
+    @timeline.command()
+    @click.option('--username', help='Only rebuild the timeline of this user.')
+    def rebuild(username):
+        """Rebuild the materialized home timelines from the database."""
+        if not app.timeline:
+            raise RuntimeError('TIMELINE_BACKEND is not configured')
+        users = User.query.filter_by(username=username) if username else User.query
+        count = 0
+        for user in users:
+            rebuild_timeline(user)
+            count += 1
+        click.echo(f'Rebuilt {count} timeline(s)')
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    def reconcile():
+        """Recompute the user counters and repair any drift."""
+        count = User.reconcile_counters()
+        db.session.commit()
+        click.echo(f'Repaired the counters of {count} user(s)')
+
+    @app.cli.group()
+    def notifications():
+        """Notification store commands."""
+        pass
+
+    @notifications.command()
+    @click.option('--max-age', type=int, help='Seconds since the last update after which a notification expires.')
+    def expire(max_age):
+        """Delete stale notifications, run it periodically from cron."""
+        count = Notification.expire(max_age or app.config['NOTIFICATIONS_MAX_AGE'])
+        db.session.commit()
+        click.echo(f'Expired {count} notification(s)')
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--chunk-size', type=int, help='Documents per bulk request.')
+    def reindex(chunk_size):
+        """Rebuild the search index of the posts."""
+        if not app.search:
+            raise RuntimeError('No search backend is configured, see SEARCH_BACKEND')
+
+        def progress(count, elapsed):
+            click.echo(f'{count} documents indexed in {elapsed:.1f}s ({count / max(elapsed, 1e-6):.0f} docs/s)')
+
+        count = Post.reindex(chunk_size or app.config['ELASTICSEARCH_CHUNK_SIZE'], progress)
+        click.echo(f'Reindexed {count} posts')
+
+    @app.cli.command()
+    @click.argument('name', type=click.Choice(['posts', 'users', 'follows']))
+    @click.option('--since', help='Only export rows created or changed since this ISO 8601 UTC date and time.')
+    @click.option('--output', type=click.File('w'), default='-', help='File to write, standard output by default.')
+    def export(name, since, output):
+        """Export posts, users or follower edges as NDJSON."""
+        for line in ndjson(EXPORTS[name](parse_since(since) if since else None)):
+            output.write(line)
+
+    def finish(index):
+        click.echo('Reconciling counters' + (' and reindexing posts' if index and app.search else ''))
+        drifted, indexed = finish_import(index)
+        click.echo(f'Repaired the counters of {drifted} user(s)')
+        if indexed is not None:
+            click.echo(f'Reindexed {indexed} posts')
+
+    @app.cli.command('import')
+    @click.argument('name', type=click.Choice(['users', 'posts', 'follows']))
+    @click.argument('file', type=click.File('r'))
+    @click.option('--format', type=click.Choice(['ndjson', 'csv']), help='Defaults to csv for .csv files, ndjson otherwise.')
+    @click.option('--batch-size', type=int, help='Rows per INSERT.')
+    @click.option('--password', help='Password of imported users that have no password or password_hash.')
+    @click.option('--index/--no-index', default=True, help='Rebuild the search index after the import.')
+    def import_(name, file, format, batch_size, password, index):
+        """Bulk insert users, posts or follower edges from an NDJSON or CSV file.
+
+        The columns are named as in the output of the export command."""
+        format = format or ('csv' if file.name.endswith('.csv') else 'ndjson')
+        start = time()
+        count = import_rows(name, read_rows(file, format), batch_size or app.config['IMPORT_BATCH_SIZE'], password)
+        click.echo(f'Imported {count} {name} in {time() - start:.1f}s')
+        finish(index)
+
+    @app.cli.command()
+    @click.option('--users', type=int, default=1000, help='Users to create.')
+    @click.option('--posts', type=int, default=10, help='Average posts per user.')
+    @click.option('--follows', type=int, default=20, help='Average users followed per user.')
+    @click.option('--exponent', type=float, default=1.0, help='Power law exponent of the follower distribution.')
+    @click.option('--password', default='password',
+                  help='Password of every created user, all the users share one salted hash of it.')
+    @click.option('--seed', type=int, help='Random seed, for repeatable data.')
+    @click.option('--batch-size', type=int, help='Rows per INSERT.')
+    @click.option('--index/--no-index', default=True, help='Rebuild the search index once everything is inserted.')
+    def seed(users, posts, follows, exponent, password, seed, batch_size, index):
+        """Fill the database with synthetic users, posts and follower edges."""
+        first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+        graph = SyntheticGraph(users, posts, follows, exponent, seed, first_id)
+        batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+        for name, rows in [('users', graph.user_rows()), ('posts', graph.post_rows()), ('follows', graph.follow_rows())]:
+            start = time()
+            count = import_rows(name, rows, batch_size, password, shared_hash=True)
+            click.echo(f'Inserted {count} {name} in {time() - start:.1f}s')
+        finish(index)
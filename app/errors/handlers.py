@@ -37,3 +37,10 @@ def method_not_allowed(error):
     if wants_json_response():
         return api_error_response(403)
     return render_template('errors/500.html'), 403
+
+
+@bp.app_errorhandler(400)
+def bad_request_error(error):
+    if wants_json_response():
+        return api_error_response(400)
+    return render_template('errors/500.html'), 400
@@ -0,0 +1,58 @@
+import json
+from datetime import datetime
+from flask import current_app
+from app import db
+from app.models import User, Post, followers
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat() + 'Z'
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _rows(query, watermark, since):
+    """Stream the rows of query changed at or after since, oldest first, without loading them all.
+
+    Rows that share the watermark of the last exported row are exported again on the next pull
+    rather than missed, so consumers should upsert on the keys."""
+    if since is not None:
+        query = query.filter(watermark >= since)
+    query = query.order_by(watermark.asc()).execution_options(stream_results=True)
+    for row in query.yield_per(current_app.config['EXPORT_CHUNK_SIZE']):
+        yield row._asdict()
+
+
+def parse_since(value):
+    """Parse an ISO 8601 UTC watermark such as the timestamps found in the exports."""
+    return datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+
+
+def export_posts(since=None):
+    query = db.session.query(Post.id, Post.user_id, Post.body, Post.language, Post.timestamp)
+    return _rows(query, Post.timestamp, since)
+
+
+def export_users(since=None):
+    query = db.session.query(User.id, User.username, User.about_me, User.last_seen, User.post_count,
+                             User.follower_count, User.followed_count, User.last_modified)
+    return _rows(query, User.last_modified, since)
+
+
+def export_follows(since=None):
+    """Stream the follower edges. Unfollows leave no trace, a full export is needed to see them."""
+    query = db.session.query(followers.c.follower_id, followers.c.followed_id, followers.c.timestamp)
+    return _rows(query, followers.c.timestamp, since)
+
+
+EXPORTS = {
+    'posts': export_posts,
+    'users': export_users,
+    'follows': export_follows,
+}
+
+
+def ndjson(rows):
+    """Encode rows as newline delimited JSON, one line at a time."""
+    for row in rows:
+        yield json.dumps(row, default=_default) + '\n'
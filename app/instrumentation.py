@@ -0,0 +1,130 @@
+import json
+from contextlib import contextmanager
+from time import perf_counter
+from flask import g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestTimings(object):
+    """What the current request spent its time on."""
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = []
+        self.template = 0.0
+        self.external = {}
+
+    def add_external(self, name, seconds):
+        count, total = self.external.get(name, (0, 0.0))
+        self.external[name] = (count + 1, total + seconds)
+
+    @property
+    def db(self):
+        return sum(seconds for seconds, _ in self.queries)
+
+    def server_timing(self, total):
+        metrics = [f'total;dur={total * 1e3:.1f}',
+                   f'db;dur={self.db * 1e3:.1f};desc="{len(self.queries)} queries"',
+                   f'template;dur={self.template * 1e3:.1f}']
+        for name, (count, seconds) in self.external.items():
+            metrics.append(f'{name};dur={seconds * 1e3:.1f};desc="{count} calls"')
+        return ', '.join(metrics)
+
+    def record(self, response, total, slowest):
+        return {
+            'method': request.method,
+            'path': request.full_path if request.query_string else request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'total_ms': round(total * 1e3, 1),
+            'queries': len(self.queries),
+            'db_ms': round(self.db * 1e3, 1),
+            'template_ms': round(self.template * 1e3, 1),
+            'external': {name: {'calls': count, 'ms': round(seconds * 1e3, 1)}
+                         for name, (count, seconds) in self.external.items()},
+            'slowest_queries': [{'ms': round(seconds * 1e3, 1), 'statement': statement}
+                                for seconds, statement in sorted(self.queries, reverse=True)[:slowest]],
+        }
+
+
+def current_timings():
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+
+@contextmanager
+def external_call(name):
+    """Time a call to an external service, such as Elasticsearch, for the current request."""
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_external(name, perf_counter() - start)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_timings() is not None:
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = current_timings()
+    if timings is not None and conn.info.get('query_start'):
+        timings.queries.append((perf_counter() - conn.info['query_start'].pop(), statement))
+
+
+def handle_error(context):
+    # A failed statement never reaches after_cursor_execute, its start time must not be taken for the next one's
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        timings = current_timings()
+        if timings is None:
+            return super().render(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            timings.template += perf_counter() - start
+
+
+def instrument(app):
+    """Record the SQL, template and external call time of every request.
+
+    The totals go into a Server-Timing header and a JSON log line per request. Requests slower than
+    SLOW_REQUEST_THRESHOLD seconds are logged as warnings with every statement they ran."""
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+    # Flask signals need blinker, so template time is taken from the templates themselves
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_timings():
+        g.timings = RequestTimings()
+
+    @app.after_request
+    def report_timings(response):
+        timings = current_timings()
+        if timings is None:
+            return response
+        total = perf_counter() - timings.start
+        response.headers['Server-Timing'] = timings.server_timing(total)
+        record = timings.record(response, total, app.config['INSTRUMENTATION_SLOWEST_QUERIES'])
+        if total >= app.config['SLOW_REQUEST_THRESHOLD']:
+            record['all_queries'] = [statement for _, statement in timings.queries]
+            app.logger.warning(json.dumps(record))
+        else:
+            app.logger.info(json.dumps(record))
+        return response
@@ -1,20 +1,27 @@
+import json
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort, \
+    Response
 from flask_login import current_user, login_required
 from flask_babel import get_locale
 from guess_language import guess_language
 from app import db
 from app.main import bp
 from app.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
-from app.models import User, Post, Message, Notification
-from app.translate import translate_post
+from app.models import User, Post, Message, Notification, Conversation, Participant
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from app import tasks
+from app.activity import record_activity
+from app.cache import cached_response, invalidate
+from app.timeline import timeline_page, push_post, add_followed, remove_followed
+from app.pagination import paginate, pagination_args, pagination_urls
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        record_activity(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -26,10 +33,12 @@ def index():
     template = 'index.html'
     title = 'Home'
     form = PostForm()
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_post().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    per_page = current_app.config['POSTS_PER_PAGE']
+    args = pagination_args()
+    posts = timeline_page(current_user, per_page, **args)
+    if posts is None:
+        posts = paginate(current_user.followed_post(), Post, per_page, **args)
+    next_url, prev_url = pagination_urls('main.index', posts)
     if not form.validate_on_submit():
         return render_template(template, title=title, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
     language = guess_language(form.post.data)
@@ -38,34 +47,37 @@ def index():
     post = Post(author=current_user, body=form.post.data, language=language)
     db.session.add(post)
     db.session.commit()
+    push_post(post)
+    invalidate('explore', f'user:{current_user.username}')
     flash('Your post is now live')
     return redirect(url_for('main.index'))
 
 
 @bp.route('/explore')
+@cached_response('explore')
 def explore():
     template = 'index.html'
     title = 'Explore'
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+    query = Post.query.options(db.joinedload(Post.author)).order_by(Post.timestamp.desc())
+    posts = paginate(query, Post, current_app.config['POSTS_PER_PAGE'], **pagination_args())
+    next_url, prev_url = pagination_urls('main.explore', posts)
     return render_template(template, title=title, posts=posts.items, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/user/<username>')
+@cached_response('user:{username}')
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     template = 'user.html'
     title = user.username
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=username, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=username, page=posts.prev_num) if posts.has_prev else None
+    posts = paginate(user.posts.order_by(Post.timestamp.desc()), Post, current_app.config['POSTS_PER_PAGE'],
+                     **pagination_args())
+    next_url, prev_url = pagination_urls('main.user', posts, username=username)
     return render_template(template, title=title, user=user, posts=posts.items, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/user/<username>/popup')
+@cached_response('user:{username}')
 def user_popup(username):
     user = User.query.filter_by(username=username).first_or_404()
     template = 'user_popup.html'
@@ -84,9 +96,11 @@ def edit_profile():
     if not form.validate_on_submit():
         return render_template(template, title=title, form=form)
     # POST request with form data validated
+    username = current_user.username
     current_user.username = form.username.data
     current_user.about_me = form.about_me.data
     db.session.commit()
+    invalidate('explore', f'user:{username}', f'user:{current_user.username}')
     return redirect(url_for('main.user', username=current_user.username))
 
 
@@ -102,6 +116,8 @@ def follow(username):
         return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
+    add_followed(current_user, user)
+    invalidate(f'user:{current_user.username}', f'user:{username}')
     flash(f'You are now following {username}!')
     return redirect(url_for('main.user', username=username))
 
@@ -118,6 +134,8 @@ def unfollow(username):
         return redirect(url_for('main.user', username=username))
     current_user.unfollow(user)
     db.session.commit()
+    remove_followed(current_user, user)
+    invalidate(f'user:{current_user.username}', f'user:{username}')
     flash(f'You are not following {username}!')
     return redirect(url_for('main.user', username=username))
 
@@ -125,10 +143,50 @@ def unfollow(username):
 @bp.route('/translate', methods=['POST'])
 @login_required
 def translate_text():
-    translated_text = {
-        'text': translate_post(request.form['text'], request.form['to_language']),
-    }
-    return jsonify(translated_text)
+    job = tasks.translate_text.delay(request.form['text'], request.form['to_language'],
+                                     request.form.get('from_language'), meta={'user_id': current_user.id})
+    if not isinstance(job, Job):
+        return jsonify({'text': job})
+    return jsonify({'job': url_for('main.translation_job', job_id=job.get_id())}), 202
+
+
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('to_language'), str) or \
+            not isinstance(data.get('post_ids'), list) or \
+            not all(isinstance(id, int) and not isinstance(id, bool) for id in data['post_ids']):
+        abort(400)
+    # The page sends its posts in batches of this size, a larger batch is refused instead of half translated
+    if len(data['post_ids']) > current_app.config['TRANSLATE_BATCH_SIZE']:
+        abort(400)
+    texts = {}
+    for post in Post.query.filter(Post.id.in_(data['post_ids'])):
+        texts.setdefault(post.language or '', {})[post.id] = post.body
+    job = tasks.translate_posts.delay(texts, data['to_language'], meta={'user_id': current_user.id})
+    if not isinstance(job, Job):
+        return jsonify({'translations': job})
+    return jsonify({'job': url_for('main.translation_job', job_id=job.get_id())}), 202
+
+
+@bp.route('/translate/<job_id>')
+@login_required
+def translation_job(job_id):
+    try:
+        job = Job.fetch(job_id, connection=current_app.redis)
+    except NoSuchJobError:
+        return jsonify({'text': 'Error: the translation has expired.', 'translations': {}})
+    # Job ids are not secret, only the user that asked for a translation may read it
+    if job.meta.get('user_id') != current_user.id:
+        abort(404)
+    if job.is_finished:
+        if isinstance(job.result, dict):
+            return jsonify({'translations': job.result})
+        return jsonify({'text': job.result})
+    if job.is_failed:
+        return jsonify({'text': 'Error: the translation service failed.', 'translations': {}})
+    return jsonify({'job': url_for('main.translation_job', job_id=job_id)}), 202
 
 
 @bp.route('/search')
@@ -141,8 +199,10 @@ def search():
     page = request.args.get('page', 1, type=int)
     posts_page = current_app.config['POSTS_PER_PAGE']
     posts, total = Post.search(g.search_form.search.data, page, posts_page)
-    next_url = url_for('main.search', q=page + 1) if total > page * posts_page else None
-    prev_url = url_for('main.search', q=page - 1) if page > 1 else None
+    posts = posts.options(db.joinedload(Post.author))
+    next_url = url_for('main.search', search=g.search_form.search.data, page=page + 1) \
+        if total > page * posts_page else None
+    prev_url = url_for('main.search', search=g.search_form.search.data, page=page - 1) if page > 1 else None
     return render_template(template, title=title, posts=posts, next_url=next_url, prev_url=prev_url)
 
 
@@ -157,10 +217,10 @@ def send_message(recipient):
         return render_template(template, title=title, form=form, recipient=recipient)
     message = Message(body=form.message.data, author=current_user, recipient=user)
     db.session.add(message)
-    user.add_notification('unread_message_count', user.new_messages())
     db.session.commit()
+    tasks.update_unread_message_count.delay(user.id)
     flash(f'Message sent to {recipient} successfully!')
-    return redirect(url_for('main.user', username=recipient))
+    return redirect(url_for('main.conversation', username=recipient))
 
 
 @bp.route('/messages')
@@ -169,21 +229,77 @@ def messages():
     template = 'messages.html'
     title = 'Messages'
     current_user.last_message_read_time = datetime.utcnow()
+    current_user.unread_message_count = 0
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=messages.next_num) if messages.has_next else None
-    prev_url = url_for('main.index', page=messages.prev_num) if messages.has_prev else None
-    return render_template(template, title=title, messages=messages.items,  next_url=next_url, prev_url=prev_url)
+    # The inbox is one range of the (user_id, timestamp) index, with the rest joined on primary keys
+    conversation = db.joinedload(Participant.conversation)
+    query = Participant.query.filter_by(user_id=current_user.id).options(
+        conversation.joinedload(Conversation.last_message).joinedload(Message.author),
+        conversation.joinedload(Conversation.user1), conversation.joinedload(Conversation.user2)
+    ).order_by(Participant.timestamp.desc(), Participant.conversation_id.desc())
+    conversations = paginate(query, Participant, current_app.config['POSTS_PER_PAGE'], **pagination_args())
+    next_url, prev_url = pagination_urls('main.messages', conversations)
+    return render_template(template, title=title, conversations=[entry.conversation for entry in conversations.items],
+                           next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/messages/<username>')
+@login_required
+def conversation(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    template = 'conversation.html'
+    title = f'Messages with {user.username}'
+    conversation = Conversation.between(current_user, user)
+    query = conversation.messages if conversation else Message.query.filter(db.false())
+    query = query.options(db.joinedload(Message.author)).order_by(Message.timestamp.desc())
+    messages = paginate(query, Message, current_app.config['POSTS_PER_PAGE'], **pagination_args())
+    next_url, prev_url = pagination_urls('main.conversation', messages, username=username)
+    return render_template(template, title=title, user=user, messages=messages.items, next_url=next_url,
+                           prev_url=prev_url)
 
 
 @bp.route('/notifications')
 @login_required
 def notifications():
-    since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications\
-        .filter(Notification.timestamp > since)\
-        .order_by(Notification.timestamp.asc())
-    notif_list = [{'name': n.name, 'data': n.get_data(), 'timestamp': n.timestamp} for n in notifications]
+    since = request.args.get('since', 0, type=int)
+    subscription = None
+    if request.args.get('wait', type=int) and current_app.config['NOTIFICATIONS_PUSH']:
+        # Subscribe before querying so nothing published in between is missed
+        subscription = current_app.notification_broker.subscribe(Notification.channel(current_user.id))
+    try:
+        notif_list = current_user.notifications_since(since)
+        if not notif_list and subscription is not None:
+            db.session.remove()
+            for message in subscription.listen(current_app.config['NOTIFICATIONS_TIMEOUT']):
+                notif_list.append(message)
+                break
+    finally:
+        if subscription is not None:
+            subscription.close()
     return jsonify(notif_list)
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    if not current_app.config['NOTIFICATIONS_PUSH']:
+        abort(404)
+    since = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', 0, type=int)
+    subscription = current_app.notification_broker.subscribe(Notification.channel(current_user.id))
+    backlog = current_user.notifications_since(since)
+    timeout = current_app.config['NOTIFICATIONS_TIMEOUT']
+
+    def stream():
+        # The stream ends after the timeout and the browser reconnects with the last event id
+        try:
+            yield 'retry: 1000\n\n'
+            for message in backlog:
+                yield f'id: {message["seq"]}\ndata: {json.dumps(message)}\n\n'
+            for message in subscription.listen(timeout):
+                yield f'id: {message["seq"]}\ndata: {json.dumps(message)}\n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache',
+                                                                       'X-Accel-Buffering': 'no'})
@@ -1,64 +1,138 @@
 import json
 import os
+import sqlite3
 from time import time
 from hashlib import md5
 from base64 import b64encode
 from app import db, login
 from datetime import datetime, timedelta
-from flask import url_for
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import url_for, request, current_app
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from flask_login import UserMixin
-from app.search import add_to_index, remove_from_index, query_index
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.exc import IntegrityError
+from app.search import bulk_index, bulk_remove, documents, query_index, create_index, drop_index
+from app.pagination import KeysetPagination, paginate, pagination_urls
 
 
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
+        if not ids:
+            return cls.query.filter_by(id=0), total
         when = []
         for i in range(len(ids)):
             when.append((ids[i], i))
         return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
 
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """Collect the documents written and the ids deleted by every flush of the transaction, per index."""
+        changes = session._changes = getattr(session, '_changes', None) or {}
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, SearchableMixin):
+                indexed, removed = changes.setdefault(obj.__tablename__, ({}, set()))
+                indexed.update(documents([obj]))
+                removed.discard(obj.id)
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                indexed, removed = changes.setdefault(obj.__tablename__, ({}, set()))
+                indexed.pop(obj.id, None)
+                removed.add(obj.id)
+
+    @staticmethod
+    def pop_changes(session):
+        changes = getattr(session, '_changes', None) or {}
+        session._changes = None
+        return changes
+
     @classmethod
     def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+        if not current_app.search or not current_app.search.transactional:
+            return
+        # An index kept in the database is written in the same transaction as the rows
+        session.flush()
+        for index, (indexed, removed) in cls.pop_changes(session).items():
+            bulk_index(index, indexed)
+            bulk_remove(index, list(removed))
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+        from app.tasks import index_documents, remove_documents
+        changes = cls.pop_changes(session)
+        if not current_app.search:
+            return
+        # Changes are grouped per index so that each commit sends one bulk request per index
+        for index, (indexed, removed) in changes.items():
+            if indexed:
+                index_documents.delay(index, indexed)
+            if removed:
+                remove_documents.delay(index, list(removed))
+
+    @classmethod
+    def after_rollback(cls, session):
         session._changes = None
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, chunk_size=500, progress=None):
+        """Index every row of the table in bulk requests of chunk_size documents.
+
+        Rows are streamed with a server-side cursor where the database supports it. progress, if
+        given, is called after every chunk with the number of documents indexed and the elapsed
+        seconds. Returns the number of documents indexed."""
+        query = cls.query.order_by(cls.id).execution_options(stream_results=True).yield_per(chunk_size)
+        start = time()
+        count = 0
+        chunk = []
+        for obj in query:
+            chunk.append(obj)
+            if len(chunk) == chunk_size:
+                bulk_index(cls.__tablename__, documents(chunk))
+                count += len(chunk)
+                chunk = []
+                if progress:
+                    progress(count, time() - start)
+        if chunk:
+            bulk_index(cls.__tablename__, documents(chunk))
+            count += len(chunk)
+            if progress:
+                progress(count, time() - start)
+        # Commits the writes of a database index
+        db.session.commit()
+        return count
 
+    @classmethod
+    def create_search_index(cls, target, connection, **kw):
+        create_index(connection, cls.__tablename__, cls.__searchable__)
 
+    @classmethod
+    def drop_search_index(cls, target, connection, **kw):
+        drop_index(connection, cls.__tablename__)
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = query.paginate(page, per_page, False)
+    @classmethod
+    def to_collection_dict(cls, query, per_page, endpoint, page=None, after=None, before=None, resources=None,
+                           fields=None, **kwargs):
+        if resources is None:
+            resources = paginate(query, cls, per_page, page=page, after=after, before=before)
+        if fields is not None:
+            kwargs['fields'] = ','.join(sorted(fields))
+        next_url, prev_url = pagination_urls(endpoint, resources, per_page=per_page, **kwargs)
+        if isinstance(resources, KeysetPagination):
+            self_url = url_for(endpoint, after=request.args.get('after'), before=request.args.get('before'),
+                               per_page=per_page, **kwargs)
+        else:
+            self_url = url_for(endpoint, page=page, per_page=per_page, **kwargs)
         data = {
-            'items': [resource.to_dict() for resource in resources.items],
+            'items': [resource.to_dict(fields=fields) for resource in resources.items],
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -66,26 +140,38 @@ class PaginatedAPIMixin(object):
                 'total_items': resources.total
             },
             '_links': {
-                'self': url_for(endpoint, page=page, per_page=per_page, **kwargs),
-                'next': url_for(endpoint, page=page + 1, per_page=per_page, **kwargs) if resources.has_next else None,
-                'prev': url_for(endpoint, page=page - 1, per_page=per_page, **kwargs) if resources.has_prev else None
+                'self': self_url,
+                'next': next_url,
+                'prev': prev_url
             }
         }
         return data
 
+    @staticmethod
+    def collection_etag(resources):
+        """Digest of a page of resources built from the validators of its items."""
+        values = [resources.total, resources.has_next, resources.has_prev, [item.etag() for item in resources.items]]
+        return md5(json.dumps(values).encode('UTF-8')).hexdigest()
+
 
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime, index=True, default=datetime.utcnow),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 
 class User(UserMixin, PaginatedAPIMixin, db.Model):
+    __keyset__ = ['id']
+    __api_fields__ = ['id', 'username', 'last_seen', 'about_me', 'post_count', 'follower_count', 'followed_count',
+                      '_links']
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
     email = db.Column(db.String(120), index=True, unique=True)
+    avatar_hash = db.Column(db.String(32))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
@@ -103,18 +189,60 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unread_message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    notification_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_modified = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f'<User {self.username}>'
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'],
+                                                    salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+
+    @classmethod
+    def validate_password_policy(cls, method, salt_length):
+        """Raise ValueError unless method is a supported hash method whose hashes fit the column."""
+        parts = method.split(':')
+        if method.startswith('pbkdf2:') and len(parts) > 2 and not parts[2].isdigit():
+            raise ValueError(f'{method} has invalid iterations')
+        # A single round is enough to check the method without paying for the configured iterations
+        probe = ':'.join(parts[:2] + ['1']) if method.startswith('pbkdf2:') else method
+        length = len(generate_password_hash('', method=probe, salt_length=salt_length)) - len(probe) + len(method)
+        if length > cls.password_hash.type.length:
+            raise ValueError(f'{method} hashes are {length} characters long, password_hash holds '
+                             f'{cls.password_hash.type.length}')
+
+    def password_needs_rehash(self):
+        method, salt, _ = self.password_hash.split('$', 2)
+        wanted = current_app.config['PASSWORD_HASH_METHOD']
+        if wanted.startswith('pbkdf2:') and wanted.count(':') == 1:
+            wanted = f'{wanted}:{DEFAULT_PBKDF2_ITERATIONS}'
+        return method != wanted or len(salt) != current_app.config['PASSWORD_SALT_LENGTH']
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check the password and upgrade the stored hash if the hashing policy has changed."""
+        if not check_password_hash(self.password_hash, password):
+            return False
+        if self.password_needs_rehash():
+            self.set_password(password)
+        return True
+
+    @staticmethod
+    def email_hash(email):
+        return md5(email.lower().encode('UTF-8')).hexdigest()
+
+    @db.validates('email')
+    def validate_email(self, key, email):
+        # The gravatar digest is stored so that avatar() does not hash the email on every call
+        self.avatar_hash = self.email_hash(email) if email else None
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('UTF-8')).hexdigest()
+        digest = self.avatar_hash or self.email_hash(self.email)
         return f'http://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
 
     def is_following(self, user):
@@ -123,44 +251,88 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self._count_follow(user, 1)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self._count_follow(user, -1)
+
+    def _count_follow(self, user, delta):
+        """Apply a follow or unfollow to the counters of both users.
+
+        The counters are updated in the database right away with SQL expressions, so concurrent follows
+        cannot lose an increment and several follows before a flush each count."""
+        if self.id is None or user.id is None:
+            db.session.flush()
+        db.session.execute(User.__table__.update().where(User.id == self.id)
+                           .values(followed_count=User.followed_count + delta))
+        db.session.execute(User.__table__.update().where(User.id == user.id)
+                           .values(follower_count=User.follower_count + delta))
+        db.session.expire(self, ['followed_count'])
+        db.session.expire(user, ['follower_count'])
 
     def followed_post(self):
         return Post.query\
             .join(followers, (followers.c.followed_id == Post.user_id))\
             .filter(followers.c.follower_id == self.id)\
             .union(Post.query.filter_by(user_id=self.id))\
+            .options(db.joinedload(Post.author))\
             .order_by(Post.timestamp.desc())
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(Message.timestamp > last_read_time).count()
+        return self.unread_message_count
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
-
-    def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.isoformat() + 'Z',
-            'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            '_links': {
+        """Store data as the latest value of the named notification, updating its row in place.
+
+        Returns the sequence number given to the notification. Sequence numbers only grow for each
+        user, incrementing the counter also locks the user row so concurrent updates are serialized."""
+        if self.id is None:
+            db.session.flush()
+        db.session.execute(User.__table__.update().where(User.id == self.id)
+                           .values(notification_seq=User.notification_seq + 1))
+        seq = db.session.query(User.notification_seq).filter(User.id == self.id).scalar()
+        Notification.upsert(self.id, name, {'payload_json': json.dumps(data), 'seq': seq, 'timestamp': time()})
+        # Published to the subscribers of the user once the transaction commits
+        db.session.info.setdefault('notifications', []).append((self.id, {'name': name, 'data': data, 'seq': seq}))
+        return seq
+
+    def get_last_seen(self):
+        """Return the last activity time, including activity that has not been flushed to the database."""
+        pending = current_app.activity.get(self.id)
+        if pending is None or (self.last_seen is not None and self.last_seen > pending):
+            return self.last_seen
+        return pending
+
+    def etag(self):
+        """Digest of the values exposed by to_dict, a validator that is cheap to compute for conditional requests."""
+        values = [self.id, self.username, self.about_me, self.avatar_hash, self.post_count, self.follower_count,
+                  self.followed_count, self.get_last_seen().isoformat()]
+        return md5(json.dumps(values).encode('UTF-8')).hexdigest()
+
+    def get_last_modified(self):
+        return max(self.last_modified or datetime.min, self.get_last_seen())
+
+    def notifications_since(self, since):
+        notifications = self.notifications.filter(Notification.seq > since).order_by(Notification.seq.asc())
+        return [{'name': n.name, 'data': n.get_data(), 'seq': n.seq} for n in notifications]
+
+    def to_dict(self, include_email=False, fields=None):
+        """Return the API representation, limited to the names in fields when given. The id is always included."""
+        data = {'id': self.id}
+        for field in ['username', 'about_me', 'post_count', 'follower_count', 'followed_count']:
+            if fields is None or field in fields:
+                data[field] = getattr(self, field)
+        if fields is None or 'last_seen' in fields:
+            data['last_seen'] = self.get_last_seen().isoformat() + 'Z'
+        if fields is None or '_links' in fields:
+            data['_links'] = {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
                 'followed': url_for('api.get_followed', id=self.id),
                 'avatar': self.avatar(size=128)
             }
-        }
         if include_email:
             data['email'] = self.email
         return data
@@ -176,6 +348,8 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
+        if self.token and current_app.token_cache:
+            current_app.token_cache.delete(self.token)
         self.token = b64encode(os.urandom(24)).decode('UTF-8')
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
@@ -183,6 +357,8 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        if self.token and current_app.token_cache:
+            current_app.token_cache.delete(self.token)
 
     @staticmethod
     def check_token(token):
@@ -191,6 +367,24 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
             return None
         return user
 
+    @staticmethod
+    def reconcile_counters():
+        """Recompute the denormalized counters from the source tables and return how many users drifted."""
+        counters = {
+            'post_count': db.select([db.func.count(Post.id)]).where(Post.user_id == User.id).as_scalar(),
+            'follower_count': db.select([db.func.count()]).where(followers.c.followed_id == User.id).as_scalar(),
+            'followed_count': db.select([db.func.count()]).where(followers.c.follower_id == User.id).as_scalar(),
+            'unread_message_count': db.select([db.func.count(Message.id)]).where(db.and_(
+                Message.recipient_id == User.id,
+                Message.timestamp > db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1))
+            )).as_scalar(),
+        }
+        drifted = User.query.filter(db.or_(*[getattr(User, name) != value for name, value in counters.items()]))
+        count = drifted.count()
+        if count:
+            User.query.update(counters, synchronize_session=False)
+        return count
+
 
 @login.user_loader
 def load_user(id):
@@ -199,6 +393,8 @@ def load_user(id):
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    __keyset__ = ['timestamp', 'id']
+    __table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -208,22 +404,128 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return f'<Post {self.body}>'
 
+    @staticmethod
+    def after_insert(mapper, connection, post):
+        connection.execute(User.__table__.update().where(User.id == post.user_id)
+                           .values(post_count=User.post_count + 1))
+
+    @staticmethod
+    def after_delete(mapper, connection, post):
+        connection.execute(User.__table__.update().where(User.id == post.user_id)
+                           .values(post_count=User.post_count - 1))
+
+
+db.event.listen(Post, 'after_insert', Post.after_insert)
+db.event.listen(Post, 'after_delete', Post.after_delete)
+db.event.listen(Post.__table__, 'after_create', Post.create_search_index)
+db.event.listen(Post.__table__, 'before_drop', Post.drop_search_index)
+
 
 class Message(db.Model):
+    __keyset__ = ['timestamp', 'id']
+    __table_args__ = (db.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),
+                      db.Index('ix_message_conversation_id_timestamp', 'conversation_id', 'timestamp'))
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
     def __repr__(self):
         return f'<Message {self.body}>'
 
+    @staticmethod
+    def before_insert(mapper, connection, message):
+        if message.conversation_id is None:
+            message.conversation_id = Conversation.get_or_create(connection, message.sender_id, message.recipient_id)
+
+    @staticmethod
+    def after_insert(mapper, connection, message):
+        connection.execute(User.__table__.update().where(User.id == message.recipient_id)
+                           .values(unread_message_count=User.unread_message_count + 1))
+        connection.execute(Conversation.__table__.update().where(Conversation.id == message.conversation_id)
+                           .values(last_message_id=message.id, timestamp=message.timestamp))
+        connection.execute(Participant.__table__.update().where(Participant.conversation_id == message.conversation_id)
+                           .values(timestamp=message.timestamp))
+
+
+db.event.listen(Message, 'before_insert', Message.before_insert)
+db.event.listen(Message, 'after_insert', Message.after_insert)
+
+
+class Conversation(db.Model):
+    """The private messages exchanged by a pair of users, user1_id being the lower of the two ids."""
+    __table_args__ = (db.Index('ix_conversation_user1_id_user2_id', 'user1_id', 'user2_id', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    user1_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user2_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id', use_alter=True,
+                                                          name='fk_conversation_last_message_id'))
+    timestamp = db.Column(db.DateTime)
+    user1 = db.relationship('User', foreign_keys=[user1_id])
+    user2 = db.relationship('User', foreign_keys=[user2_id])
+    last_message = db.relationship('Message', foreign_keys=[last_message_id], post_update=True)
+    messages = db.relationship('Message', foreign_keys=[Message.conversation_id], backref='conversation',
+                               lazy='dynamic')
+
+    def __repr__(self):
+        return f'<Conversation {self.user1_id} {self.user2_id}>'
+
+    def other(self, user):
+        return self.user2 if self.user1_id == user.id else self.user1
+
+    @staticmethod
+    def pair(user_id, other_id):
+        return min(user_id, other_id), max(user_id, other_id)
+
+    @classmethod
+    def between(cls, user, other):
+        user1_id, user2_id = cls.pair(user.id, other.id)
+        return cls.query.filter_by(user1_id=user1_id, user2_id=user2_id).first()
+
+    @staticmethod
+    def find(connection, user1_id, user2_id):
+        table = Conversation.__table__
+        return connection.execute(db.select([table.c.id]).where(db.and_(table.c.user1_id == user1_id,
+                                                                        table.c.user2_id == user2_id))).scalar()
+
+    @staticmethod
+    def get_or_create(connection, user_id, other_id):
+        """Return the id of the conversation of the pair, creating it and its inbox entries if needed."""
+        user1_id, user2_id = Conversation.pair(user_id, other_id)
+        id = Conversation.find(connection, user1_id, user2_id)
+        if id is not None:
+            return id
+        try:
+            # When both users send a first message at once, the loser of the unique index uses the other conversation
+            with connection.begin_nested():
+                id = connection.execute(Conversation.__table__.insert().values(user1_id=user1_id, user2_id=user2_id))\
+                    .inserted_primary_key[0]
+                connection.execute(Participant.__table__.insert(), [{'user_id': participant_id, 'conversation_id': id}
+                                                                    for participant_id in {user1_id, user2_id}])
+        except IntegrityError:
+            id = Conversation.find(connection, user1_id, user2_id)
+        return id
+
+
+class Participant(db.Model):
+    """A conversation as listed in the inbox of one of its users, ordered by the time of its last message."""
+    __keyset__ = ['timestamp', 'conversation_id']
+    __table_args__ = (db.Index('ix_participant_user_id_timestamp', 'user_id', 'timestamp', 'conversation_id'),)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+    conversation = db.relationship('Conversation')
+
 
 class Notification(db.Model):
+    __table_args__ = (db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),
+                      db.Index('ix_notification_user_id_seq', 'user_id', 'seq'))
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(128), index=True)
+    name = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    seq = db.Column(db.Integer)
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
 
@@ -232,3 +534,56 @@ class Notification(db.Model):
 
     def __repr__(self):
         return f'<Notification {self.name}>'
+
+    @staticmethod
+    def channel(user_id):
+        return f'notifications:{user_id}'
+
+    @staticmethod
+    def upsert(user_id, name, values):
+        """Insert the (user_id, name) notification, or update it with values if it exists."""
+        table = Notification.__table__
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            db.session.execute(postgresql.insert(table).values(user_id=user_id, name=name, **values)
+                               .on_conflict_do_update(index_elements=['user_id', 'name'], set_=values))
+            return
+        if dialect == 'mysql':
+            db.session.execute(mysql.insert(table).values(user_id=user_id, name=name, **values)
+                               .on_duplicate_key_update(**values))
+            return
+        if dialect == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24):
+            columns = ', '.join(values)
+            db.session.execute(f'INSERT INTO notification (user_id, name, {columns}) '
+                               f'VALUES (:user_id, :name, {", ".join(":" + column for column in values)}) '
+                               f'ON CONFLICT (user_id, name) DO UPDATE SET '
+                               f'{", ".join(f"{column} = excluded.{column}" for column in values)}',
+                               dict(values, user_id=user_id, name=name))
+            return
+        update = table.update().where(db.and_(table.c.user_id == user_id, table.c.name == name)).values(**values)
+        if db.session.execute(update).rowcount:
+            return
+        try:
+            # A concurrent first insert of the same name loses on the unique index and updates instead
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(user_id=user_id, name=name, **values))
+        except IntegrityError:
+            db.session.execute(update)
+
+    @staticmethod
+    def expire(max_age):
+        """Delete the notifications that have not been updated for max_age seconds and return how many."""
+        return Notification.query.filter(Notification.timestamp < time() - max_age).delete(synchronize_session=False)
+
+    @classmethod
+    def after_commit(cls, session):
+        for user_id, message in session.info.pop('notifications', []):
+            current_app.notification_broker.publish(cls.channel(user_id), message)
+
+    @classmethod
+    def after_rollback(cls, session, previous_transaction):
+        session.info.pop('notifications', None)
+
+
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', Notification.after_rollback)
@@ -0,0 +1,139 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from flask import current_app, request, url_for, abort
+from app import db
+
+
+class KeysetPagination(object):
+    """A page of results located by the keyset of its first and last items instead of an offset."""
+
+    def __init__(self, model, items, per_page, has_next, has_prev, total=None):
+        self.model = model
+        self.items = items
+        self.per_page = per_page
+        self.has_next = has_next and len(items) > 0
+        self.has_prev = has_prev and len(items) > 0
+        self.total = total
+        self.page = None
+        self.pages = None
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(keyset_values(self.model, self.items[-1])) if self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(keyset_values(self.model, self.items[0])) if self.has_prev else None
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError(f'{type(value).__name__} is not a valid cursor value')
+
+
+def _object_hook(value):
+    if '$date' in value:
+        return datetime.fromisoformat(value['$date'])
+    return value
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=_default, separators=(',', ':')).encode('UTF-8')
+    return urlsafe_b64encode(data).decode('UTF-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    values = json.loads(data.decode('UTF-8'), object_hook=_object_hook)
+    if not isinstance(values, list):
+        raise ValueError('cursor is not a list of values')
+    return values
+
+
+def keyset_values(model, item):
+    return [getattr(item, name) for name in model.__keyset__]
+
+
+def _keyset_value(column, value):
+    # Booleans are ints to Python, and larger ints do not fit in a database integer
+    if isinstance(value, bool) or not isinstance(value, column.type.python_type):
+        return False
+    return not isinstance(value, int) or -2 ** 63 <= value < 2 ** 63
+
+
+def check_cursor(model, values):
+    """Abort with 400 unless values holds one value of the right type for each keyset column of model."""
+    columns = [getattr(model, name) for name in model.__keyset__]
+    if len(values) != len(columns) or not all(_keyset_value(column, value) for column, value in zip(columns, values)):
+        abort(400)
+
+
+def _older_than(columns, values):
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        clauses.append(db.and_(*equal, column < values[i]))
+    return db.or_(*clauses)
+
+
+def _newer_than(columns, values):
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        clauses.append(db.and_(*equal, column > values[i]))
+    return db.or_(*clauses)
+
+
+def keyset_paginate(query, model, per_page, after=None, before=None, count=False):
+    """Return the page of query that comes after (older) or before (newer) the given keyset values.
+
+    Results are ordered newest first on the columns named in model.__keyset__."""
+    columns = [getattr(model, name) for name in model.__keyset__]
+    if after is not None or before is not None:
+        check_cursor(model, after if after is not None else before)
+    total = query.order_by(None).count() if count else None
+    query = query.order_by(None)
+    if before is not None:
+        rows = query.filter(_newer_than(columns, before)).order_by(*[column.asc() for column in columns])\
+            .limit(per_page + 1).all()
+        return KeysetPagination(model, rows[:per_page][::-1], per_page, True, len(rows) > per_page, total)
+    if after is not None:
+        query = query.filter(_older_than(columns, after))
+    rows = query.order_by(*[column.desc() for column in columns]).limit(per_page + 1).all()
+    return KeysetPagination(model, rows[:per_page], per_page, len(rows) > per_page, after is not None, total)
+
+
+def pagination_args():
+    """Read the pagination arguments of the current request.
+
+    Returns the page number for OFFSET pagination, or the decoded after/before cursors when cursor
+    pagination is enabled in the configuration or requested by the client."""
+    after = request.args.get('after')
+    before = request.args.get('before')
+    if not after and not before and not current_app.config['CURSOR_PAGINATION']:
+        return {'page': request.args.get('page', 1, type=int)}
+    try:
+        return {
+            'after': decode_cursor(after) if after else None,
+            'before': decode_cursor(before) if before and not after else None,
+        }
+    except (ValueError, TypeError):
+        abort(400)
+
+
+def paginate(query, model, per_page, page=None, after=None, before=None):
+    if page is not None:
+        return query.paginate(page, per_page, False)
+    return keyset_paginate(query, model, per_page, after, before, count=current_app.config['PAGINATION_COUNT'])
+
+
+def pagination_urls(endpoint, pagination, **kwargs):
+    if isinstance(pagination, KeysetPagination):
+        next_url = url_for(endpoint, after=pagination.next_cursor, **kwargs) if pagination.has_next else None
+        prev_url = url_for(endpoint, before=pagination.prev_cursor, **kwargs) if pagination.has_prev else None
+    else:
+        next_url = url_for(endpoint, page=pagination.next_num, **kwargs) if pagination.has_next else None
+        prev_url = url_for(endpoint, page=pagination.prev_num, **kwargs) if pagination.has_prev else None
+    return next_url, prev_url
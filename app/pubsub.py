@@ -0,0 +1,85 @@
+import json
+from queue import Queue, Empty
+from threading import Lock
+from time import time
+
+
+class MemorySubscription(object):
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = Queue()
+
+    def listen(self, timeout):
+        """Yield the messages published on the channel until timeout seconds have passed."""
+        deadline = time() + timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return
+            try:
+                yield self.queue.get(timeout=remaining)
+            except Empty:
+                return
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class MemoryBroker(object):
+    """In-process publish/subscribe, only delivers to subscribers in the same process."""
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = Lock()
+
+    def subscribe(self, channel):
+        subscription = MemorySubscription(self, channel)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.channel, None)
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.queue.put(message)
+
+
+class RedisSubscription(object):
+    def __init__(self, redis, channel):
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def listen(self, timeout):
+        deadline = time() + timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return
+            message = self.pubsub.get_message(timeout=remaining)
+            if message is not None and message['type'] == 'message':
+                yield json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker(object):
+    """Publish/subscribe over Redis channels, delivers across processes and hosts."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def subscribe(self, channel):
+        return RedisSubscription(self.redis, channel)
+
+    def publish(self, channel, message):
+        self.redis.publish(channel, json.dumps(message))
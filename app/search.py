@@ -1,34 +1,167 @@
 from flask import current_app
+from sqlalchemy.engine.url import make_url
+from app import db
+from app.instrumentation import external_call
 
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
+def _document(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    return payload
+
+
+def _table(index):
+    return f'{index}_search'
+
+
+class ElasticsearchBackend(object):
+    """Search through the Elasticsearch cluster at ELASTICSEARCH_URL.
+
+    The index is updated by background tasks after the commit, so new rows show up in searches a
+    little later. Nothing is indexed or found while the cluster is not configured."""
+
+    transactional = False
+
+    def _bulk(self, actions):
+        with external_call('elasticsearch'):
+            response = current_app.elasticsearch.bulk(body=actions)
+        if response.get('errors'):
+            failed = [item for item in response['items'] if list(item.values())[0].get('error')]
+            current_app.logger.warning(f'Search bulk request failed for {len(failed)} of {len(response["items"])} items')
+        return response
+
+    def index(self, index, documents):
+        if not current_app.elasticsearch:
+            return
+        actions = []
+        for id, payload in documents.items():
+            actions.append({'index': {'_index': index, '_id': id}})
+            actions.append(payload)
+        self._bulk(actions)
+
+    def remove(self, index, ids):
+        if not current_app.elasticsearch:
+            return
+        self._bulk([{'delete': {'_index': index, '_id': id}} for id in ids])
+
+    def query(self, index, query, page, per_page):
+        if not current_app.elasticsearch:
+            return [], 0
+        query_body = {
+            'query': {
+                'multi_match': {
+                    'query': query,
+                    'fields': ['*'],
+                },
+            },
+            'from': (page - 1) * per_page,
+            'size': per_page,
+        }
+        with external_call('elasticsearch'):
+            search = current_app.elasticsearch.search(index=index, body=query_body)
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+
+class DatabaseBackend(object):
+    """Full-text search inside the application database: an FTS5 table on SQLite, a tsvector column
+    with a GIN index on Postgres.
+
+    Every searchable table has an index table named after it, see create_index. The index is written
+    in the same transaction as the rows, so searches see exactly what is committed. Results are ranked
+    by relevance (bm25 on SQLite, ts_rank on Postgres), newest first on ties."""
+
+    transactional = True
+    dialects = ['sqlite', 'postgresql']
+    # Text search configuration used to stem the documents and queries on Postgres
+    language = 'english'
 
+    @classmethod
+    def supports(cls, database_url):
+        return make_url(database_url).get_backend_name() in cls.dialects
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    def index(self, index, documents):
+        table = _table(index)
+        if db.engine.dialect.name == 'postgresql':
+            statement = (f'INSERT INTO {table} (id, document) VALUES (:id, to_tsvector(:language, :text)) '
+                         f'ON CONFLICT (id) DO UPDATE SET document = excluded.document')
+            params = [{'id': id, 'language': self.language,
+                       'text': ' '.join(value or '' for value in payload.values())}
+                      for id, payload in documents.items()]
+        else:
+            fields = list(next(iter(documents.values())))
+            statement = (f'INSERT OR REPLACE INTO {table} (rowid, {", ".join(fields)}) '
+                         f'VALUES (:id, {", ".join(":" + field for field in fields)})')
+            params = [dict(payload, id=id) for id, payload in documents.items()]
+        db.session.execute(statement, params)
+
+    def remove(self, index, ids):
+        key = 'id' if db.engine.dialect.name == 'postgresql' else 'rowid'
+        db.session.execute(f'DELETE FROM {_table(index)} WHERE {key} = :id', [{'id': id} for id in ids])
+
+    def query(self, index, query, page, per_page):
+        table = _table(index)
+        params = {'limit': per_page, 'offset': (page - 1) * per_page}
+        if db.engine.dialect.name == 'postgresql':
+            params.update(query=query, language=self.language)
+            match = f'FROM {table}, plainto_tsquery(:language, :query) query WHERE document @@ query'
+            order = 'ts_rank(document, query) DESC, id DESC'
+            key = 'id'
+        else:
+            # Every word is quoted so that the FTS5 query syntax in user input is matched literally
+            words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+            if not words:
+                return [], 0
+            params.update(query=' '.join(words))
+            match = f'FROM {table} WHERE {table} MATCH :query'
+            order = 'rank, rowid DESC'
+            key = 'rowid'
+        # The total rides along with the page, only a page past the end needs its own count
+        rows = db.session.execute(f'SELECT {key}, count(*) OVER () {match} ORDER BY {order} '
+                                  f'LIMIT :limit OFFSET :offset', params).fetchall()
+        if rows:
+            return [row[0] for row in rows], rows[0][1]
+        return [], db.session.execute(f'SELECT count(*) {match}', params).scalar()
+
+
+def create_index(connection, index, fields):
+    """Create the index table of a searchable table if the database supports it."""
+    table = _table(index)
+    if connection.dialect.name == 'sqlite':
+        connection.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} "
+                           f"USING fts5({', '.join(fields)}, tokenize='porter unicode61')")
+    elif connection.dialect.name == 'postgresql':
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)')
+        connection.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_document ON {table} USING gin (document)')
+
+
+def drop_index(connection, index):
+    if connection.dialect.name in DatabaseBackend.dialects:
+        connection.execute(f'DROP TABLE IF EXISTS {_table(index)}')
+
+
+def documents(models):
+    """Return the search documents of models keyed by id, ready for bulk_index."""
+    return {model.id: _document(model) for model in models}
+
+
+def bulk_index(index, documents):
+    """Index a batch of documents, given as a dict of id to payload, in a single request."""
+    if not current_app.search or not documents:
         return
-    current_app.elaseticsearch.delete(index=index, id=model.id)
+    current_app.search.index(index, documents)
 
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+def bulk_remove(index, ids):
+    """Remove a batch of ids from the index in a single request."""
+    if not current_app.search or not ids:
         return
-    query_body = {
-        'query': {
-            'multi_match': {
-                'query': query,
-                'fields': ['*'],
-            },
-        },
-        'from': (page - 1) * per_page,
-        'size': per_page,
-    }
-    search = current_app.elasticsearch.search(index=index, body=query_body)
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    current_app.search.remove(index, ids)
+
+
+def query_index(index, query, page, per_page):
+    """Return the ids of a page of matches, best first, and the total number of matches."""
+    if not current_app.search:
+        return [], 0
+    return current_app.search.query(index, query, page, per_page)
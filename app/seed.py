@@ -0,0 +1,154 @@
+import csv
+import json
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate, islice
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User, Post, followers
+from app.export import parse_since
+
+TABLES = {
+    'users': User.__table__,
+    'posts': Post.__table__,
+    'follows': followers,
+}
+
+
+def read_rows(file, format):
+    """Read rows from an NDJSON or CSV file one at a time. Blank CSV cells are treated as missing."""
+    if format == 'csv':
+        for row in csv.DictReader(file):
+            yield {key: value for key, value in row.items() if value != ''}
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class RowConverter(object):
+    """Turn imported rows into parameters for an INSERT into table.
+
+    Values are converted to the column types, unknown keys are dropped and users get their avatar digest
+    and a password hash. Each user gets its own salt unless shared_hash is set, then passwords are
+    hashed once per distinct value and accounts with the same password share the salt and hash. That
+    makes seeding many accounts cheap and is only fit for synthetic data."""
+
+    def __init__(self, table, password=None, shared_hash=False):
+        self.table = table
+        self.password = password
+        self.shared_hash = shared_hash
+        self.hashes = {}
+
+    def hash(self, password):
+        if not self.shared_hash:
+            return generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'],
+                                          salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+        if password not in self.hashes:
+            self.hashes[password] = generate_password_hash(
+                password, method=current_app.config['PASSWORD_HASH_METHOD'],
+                salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
+        return self.hashes[password]
+
+    def convert(self, column, value):
+        if value is None or column.type.python_type not in (int, datetime) or not isinstance(value, str):
+            return value
+        if column.type.python_type is int:
+            return int(value)
+        return parse_since(value)
+
+    def __call__(self, row):
+        params = {column.name: self.convert(column, row[column.name])
+                  for column in self.table.columns if column.name in row}
+        if self.table is User.__table__:
+            if 'email' in params:
+                params['avatar_hash'] = User.email_hash(params['email'])
+            password = row.get('password', self.password)
+            if 'password_hash' not in params and password:
+                params['password_hash'] = self.hash(password)
+        return params
+
+
+def import_rows(name, rows, batch_size, password=None, shared_hash=False):
+    """Insert rows into the users, posts or follows table with one executemany per batch.
+
+    See RowConverter for password and shared_hash.
+
+    The ORM is bypassed, so the user counters and the search index are not maintained, call
+    finish_import once all the rows are in. Returns the number of rows inserted."""
+    table = TABLES[name]
+    converter = RowConverter(table, password, shared_hash)
+    rows = iter(rows)
+    count = 0
+    while True:
+        batch = [converter(row) for row in islice(rows, batch_size)]
+        if not batch:
+            return count
+        # executemany needs the same columns in every row, rows missing some values are inserted apart
+        groups = {}
+        for params in batch:
+            groups.setdefault(tuple(sorted(params)), []).append(params)
+        for group in groups.values():
+            db.session.execute(table.insert(), group)
+        db.session.commit()
+        count += len(batch)
+
+
+def finish_import(index=True, chunk_size=None):
+    """Repair the user counters and, if index is set and search is configured, rebuild the post index in bulk."""
+    if db.engine.dialect.name == 'postgresql':
+        # Rows imported with their ids do not advance the sequences
+        for table in [User.__table__, Post.__table__]:
+            db.session.execute(f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+                               f"coalesce((SELECT max(id) FROM \"{table.name}\"), 0) + 1, false)")
+    drifted = User.reconcile_counters()
+    db.session.commit()
+    indexed = None
+    if index and current_app.search:
+        indexed = Post.reindex(chunk_size or current_app.config['ELASTICSEARCH_CHUNK_SIZE'])
+    return drifted, indexed
+
+
+class SyntheticGraph(object):
+    """Generate users, posts and follower edges with a power-law follower distribution.
+
+    Each user follows about follows other users, each picked with a probability proportional to
+    rank ** -exponent, so a few users attract most of the followers as on real social networks.
+    The same seed gives the same data."""
+
+    def __init__(self, users, posts, follows, exponent=1.0, seed=None, first_id=1):
+        self.users = users
+        self.posts = posts
+        self.follows = follows
+        self.exponent = exponent
+        self.seed = seed
+        self.ids = range(first_id, first_id + users)
+
+    def user_rows(self):
+        for id in self.ids:
+            yield {'id': id, 'username': f'user{id}', 'email': f'user{id}@example.com',
+                   'about_me': f'Synthetic user {id}'}
+
+    def post_rows(self):
+        """Each user writes about posts posts, spread over the last 30 days."""
+        rng = random.Random(self.seed)
+        now = datetime.utcnow()
+        for id in self.ids:
+            for _ in range(rng.randint(0, 2 * self.posts)):
+                yield {'user_id': id, 'body': f'Post from user{id}', 'language': 'en',
+                       'timestamp': now - timedelta(seconds=rng.randint(0, 30 * 24 * 3600))}
+
+    def follow_rows(self):
+        rng = random.Random(self.seed)
+        # Shuffle who is popular so that it does not follow the id order
+        popular = list(self.ids)
+        rng.shuffle(popular)
+        weights = list(accumulate((rank + 1) ** -self.exponent for rank in range(self.users)))
+        for id in self.ids:
+            wanted = rng.randint(0, 2 * self.follows)
+            # Drawing with replacement and dropping repeats keeps this fast, users that draw the same
+            # popular accounts several times just end up following fewer
+            followed = set(rng.choices(popular, cum_weights=weights, k=wanted)) - {id}
+            for followed_id in followed:
+                yield {'follower_id': id, 'followed_id': followed_id}
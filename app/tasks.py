@@ -0,0 +1,75 @@
+import time
+from functools import wraps
+from flask import current_app
+from app import db
+from app.models import User
+from app.search import bulk_index, bulk_remove
+from app.translate import translate_post, translate_batch
+
+
+def tasks_eager():
+    return current_app.task_queue is None or current_app.config['TASKS_EAGER']
+
+
+def task(f):
+    """Turn f into a background task.
+
+    The returned function is what the worker runs: it retries f with exponential backoff. Call
+    f.delay(*args) to enqueue it; in eager mode, or when no task queue is configured, f runs inline
+    and delay returns its result instead of the rq Job. meta, if given, is stored on the Job."""
+    @wraps(f)
+    def run(*args, **kwargs):
+        retries = current_app.config['TASK_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                db.session.rollback()
+                if attempt == retries:
+                    raise
+                delay = current_app.config['TASK_RETRY_BACKOFF'] * 2 ** attempt
+                current_app.logger.warning(f'Task {f.__name__} failed, retrying in {delay}s', exc_info=True)
+                time.sleep(delay)
+
+    def delay(*args, meta=None, **kwargs):
+        if tasks_eager():
+            return f(*args, **kwargs)
+        return current_app.task_queue.enqueue(run, *args, meta=meta, **kwargs)
+
+    run.delay = delay
+    return run
+
+
+@task
+def index_documents(index, documents):
+    bulk_index(index, documents)
+
+
+@task
+def remove_documents(index, ids):
+    bulk_remove(index, ids)
+
+
+@task
+def update_unread_message_count(user_id):
+    user = User.query.get(user_id)
+    if user is None:
+        return
+    user.add_notification('unread_message_count', user.new_messages())
+    db.session.commit()
+
+
+@task
+def translate_text(text, to_language, from_language=None):
+    return translate_post(text, to_language, from_language)
+
+
+@task
+def translate_posts(texts, to_language):
+    """Translate posts given as {source language: {post id: text}}, one batch per source language."""
+    translations = {}
+    for from_language, posts in texts.items():
+        ids = list(posts)
+        results = translate_batch([posts[id] for id in ids], to_language, from_language or None)
+        translations.update(zip(ids, results))
+    return translations
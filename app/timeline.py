@@ -0,0 +1,168 @@
+from datetime import datetime
+from threading import Lock
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from app import db
+from app.models import Post, followers
+from app.pagination import KeysetPagination, check_cursor
+
+
+class MemoryTimeline(object):
+    """In-process timeline store. Each user maps to a list of (score, post_id) kept newest first."""
+
+    def __init__(self):
+        self.timelines = {}
+        self.lock = Lock()
+
+    def exists(self, user_ids):
+        return [user_id in self.timelines for user_id in user_ids]
+
+    def add(self, user_id, entries, length):
+        with self.lock:
+            timeline = self.timelines.setdefault(user_id, [])
+            present = {post_id for _, post_id in timeline}
+            timeline.extend((score, post_id) for post_id, score in entries.items() if post_id not in present)
+            timeline.sort(reverse=True)
+            del timeline[length:]
+
+    def replace(self, user_id, entries, length):
+        with self.lock:
+            self.timelines[user_id] = []
+        self.add(user_id, entries, length)
+
+    def range(self, user_id, start, stop):
+        return [post_id for _, post_id in self.timelines.get(user_id, [])[start:stop]]
+
+    def rank(self, user_id, post_id):
+        for position, (_, entry_id) in enumerate(self.timelines.get(user_id, [])):
+            if entry_id == post_id:
+                return position
+        return None
+
+    def count(self, user_id):
+        return len(self.timelines.get(user_id, []))
+
+
+class RedisTimeline(object):
+    """Timeline store backed by one Redis sorted set per user, scored by post timestamp."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    @staticmethod
+    def key(user_id):
+        return f'timeline:{user_id}'
+
+    def exists(self, user_ids):
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.exists(self.key(user_id))
+        return [bool(result) for result in pipe.execute()]
+
+    def add(self, user_id, entries, length):
+        if not entries:
+            return
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.key(user_id), entries)
+        pipe.zremrangebyrank(self.key(user_id), 0, -length - 1)
+        pipe.execute()
+
+    def replace(self, user_id, entries, length):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key(user_id))
+        if entries:
+            pipe.zadd(self.key(user_id), entries)
+            pipe.zremrangebyrank(self.key(user_id), 0, -length - 1)
+        pipe.execute()
+
+    def range(self, user_id, start, stop):
+        return [int(post_id) for post_id in self.redis.zrevrange(self.key(user_id), start, stop - 1)]
+
+    def rank(self, user_id, post_id):
+        return self.redis.zrevrank(self.key(user_id), post_id)
+
+    def count(self, user_id):
+        return self.redis.zcard(self.key(user_id))
+
+
+def _score(timestamp):
+    return (timestamp - datetime(1970, 1, 1)).total_seconds()
+
+
+def push_post(post):
+    if not current_app.timeline:
+        return
+    follower_ids = [row[0] for row in db.session.query(followers.c.follower_id)
+                    .filter(followers.c.followed_id == post.user_id)]
+    user_ids = [post.user_id] + follower_ids
+    length = current_app.config['TIMELINE_LENGTH']
+    # Only timelines that are already materialized are updated, the rest are rebuilt on their next read.
+    for user_id, exists in zip(user_ids, current_app.timeline.exists(user_ids)):
+        if exists:
+            current_app.timeline.add(user_id, {post.id: _score(post.timestamp)}, length)
+
+
+def add_followed(user, followed):
+    if not current_app.timeline or not current_app.timeline.exists([user.id])[0]:
+        return
+    length = current_app.config['TIMELINE_LENGTH']
+    posts = db.session.query(Post.id, Post.timestamp).filter(Post.user_id == followed.id)\
+        .order_by(Post.timestamp.desc()).limit(length)
+    current_app.timeline.add(user.id, {post_id: _score(timestamp) for post_id, timestamp in posts}, length)
+
+
+def remove_followed(user, followed):
+    # Removing posts from a full timeline would leave it short of older posts that are still followed,
+    # and a short timeline passes for complete, so it is rebuilt instead
+    if not current_app.timeline or not current_app.timeline.exists([user.id])[0]:
+        return
+    rebuild_timeline(user)
+
+
+def rebuild_timeline(user):
+    if not current_app.timeline:
+        return
+    length = current_app.config['TIMELINE_LENGTH']
+    posts = user.followed_post().options(db.lazyload(Post.author)).limit(length)
+    current_app.timeline.replace(user.id, {post.id: _score(post.timestamp) for post in posts}, length)
+
+
+def _load_posts(ids):
+    if not ids:
+        return []
+    when = [(post_id, position) for position, post_id in enumerate(ids)]
+    return Post.query.filter(Post.id.in_(ids)).options(db.joinedload(Post.author))\
+        .order_by(db.case(when, value=Post.id)).all()
+
+
+def timeline_page(user, per_page, page=None, after=None, before=None):
+    """Return a page of the user's home timeline read from the store, or None to use the query.
+
+    Takes the same arguments as app.pagination.paginate and returns the same kind of pagination."""
+    if not current_app.timeline:
+        return None
+    if not current_app.timeline.exists([user.id])[0]:
+        rebuild_timeline(user)
+    total = current_app.timeline.count(user.id)
+    truncated = total >= current_app.config['TIMELINE_LENGTH']
+    if page is not None:
+        start = (page - 1) * per_page
+        if truncated and start + per_page >= total:
+            # The store only keeps the most recent posts, older pages come from the database. So does
+            # the last page it holds, since only the database knows whether more posts follow it.
+            return None
+        ids = current_app.timeline.range(user.id, start, start + per_page)
+        return Pagination(None, page, per_page, total, _load_posts(ids))
+    cursor = after or before
+    start = 0
+    if cursor is not None:
+        check_cursor(Post, cursor)
+        rank = current_app.timeline.rank(user.id, cursor[-1])
+        if rank is None:
+            return None
+        start = rank + 1 if after is not None else max(rank - per_page, 0)
+    stop = start + per_page if before is None else rank
+    if truncated and stop > total:
+        return None
+    ids = current_app.timeline.range(user.id, start, stop)
+    return KeysetPagination(Post, _load_posts(ids), per_page, stop < total or truncated, start > 0, total)
@@ -1,16 +1,107 @@
+from hashlib import sha256
+from threading import Lock
+from cachetools import TTLCache
 from google.cloud import translate
 from google.api_core.exceptions import BadRequest
+from redis.exceptions import RedisError
 from flask import current_app
+from app.instrumentation import external_call
 
+_client = None
+_client_lock = Lock()
 
-def translate_post(text, to_language):
+
+def get_client():
+    """Return the translation client of this process, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = translate.Client()
+    return _client
+
+
+class TranslationCache(object):
+    """Two tier translation cache: an in-process LRU with a TTL and an optional shared Redis tier."""
+
+    def __init__(self, maxsize, ttl, redis=None):
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.redis = redis
+        self.lock = Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text, from_language, to_language):
+        digest = sha256(text.encode('UTF-8')).hexdigest()
+        return f'translation:{from_language or "auto"}:{to_language}:{digest}'
+
+    def get(self, key):
+        with self.lock:
+            value = self.local.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        if self.redis is not None:
+            try:
+                value = self.redis.get(key)
+            except RedisError:
+                current_app.logger.warning('Translation cache is unavailable', exc_info=True)
+            if value is not None:
+                value = value.decode('UTF-8')
+                with self.lock:
+                    self.redis_hits += 1
+                    self.local[key] = value
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.local[key] = value
+        if self.redis is not None:
+            try:
+                self.redis.setex(key, self.ttl, value)
+            except RedisError:
+                current_app.logger.warning('Translation cache is unavailable', exc_info=True)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'redis_hits': self.redis_hits, 'misses': self.misses, 'size': len(self.local)}
+
+
+def translate_batch(texts, to_language, from_language=None):
+    """Translate a list of texts that share a source language.
+
+    Cached translations are reused and the rest are sent to the translation service in as few
+    requests as possible. Returns the translations, or error messages, in the order of texts."""
     if 'TRANSLATE_KEY' not in current_app.config or not current_app.config['TRANSLATE_KEY']:
-        return 'Error: the translation service is not configured.'
-    try:
-        client = translate.Client()
-        result = client.translate(text, target_language=to_language)
-    except BadRequest:
-        return 'Error: the translation service failed.'
-    if result['translatedText'] == text:
-        return 'Error: the languages are the same.'
-    return result['translatedText']
\ No newline at end of file
+        return ['Error: the translation service is not configured.'] * len(texts)
+    cache = current_app.translation_cache
+    keys = [cache.key(text, from_language, to_language) for text in texts]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    batch_size = current_app.config['TRANSLATE_BATCH_SIZE']
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        try:
+            with external_call('translate'):
+                translated = get_client().translate([texts[i] for i in batch], target_language=to_language,
+                                                    source_language=from_language)
+        except BadRequest:
+            for i in batch:
+                results[i] = 'Error: the translation service failed.'
+            continue
+        for i, result in zip(batch, translated):
+            if result['translatedText'] == texts[i]:
+                results[i] = 'Error: the languages are the same.'
+            else:
+                results[i] = result['translatedText']
+                cache.set(keys[i], results[i])
+    return results
+
+
+def translate_post(text, to_language, from_language=None):
+    return translate_batch([text], to_language, from_language)[0]
@@ -0,0 +1,69 @@
+"""Measure what storing the gravatar digest saves when rendering a timeline page.
+
+Renders a page of posts from distinct authors through _post.html, once with the stored
+avatar_hash and once with it cleared so that avatar() hashes the email on every call, as it
+did before revision c5e9f0a2b7d1. Run from the project root:
+
+    python -m benchmarks.avatar --posts 100 --repeat 200
+"""
+import argparse
+from time import perf_counter
+from flask import g, render_template_string
+from app import create_app, db
+from app.models import User, Post
+from config import Config
+
+PAGE = "{% for post in posts %}{% include '_post.html' %}{% endfor %}"
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+
+
+def render(posts, repeat):
+    render_template_string(PAGE, posts=posts)
+    start = perf_counter()
+    for _ in range(repeat):
+        render_template_string(PAGE, posts=posts)
+    return (perf_counter() - start) / repeat
+
+
+def avatars(users, repeat):
+    start = perf_counter()
+    for _ in range(repeat):
+        for user in users:
+            user.avatar(70)
+    return (perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=100, help='posts on the page, each by a different author')
+    parser.add_argument('--repeat', type=int, default=200, help='renders of the page')
+    args = parser.parse_args()
+
+    app = create_app(BenchmarkConfig)
+    with app.test_request_context():
+        db.create_all()
+        users = [User(username=f'user{i}', email=f'User{i}@Example.com') for i in range(args.posts)]
+        db.session.add_all([Post(author=user, body=f'Post {i}') for i, user in enumerate(users)])
+        db.session.commit()
+        posts = Post.query.options(db.joinedload(Post.author)).all()
+        g.locale = 'en'
+
+        stored = (render(posts, args.repeat), avatars(users, args.repeat))
+        for user in users:
+            # Bypass the email validator so avatar() falls back to hashing on every call
+            user.__dict__['avatar_hash'] = None
+        hashed = (render(posts, args.repeat), avatars(users, args.repeat))
+
+    print(f'{args.posts} posts per page, {args.repeat} renders')
+    print(f'{"":18}{"page render":>14}{"avatar() calls":>16}')
+    print(f'{"hash per call":18}{hashed[0] * 1e3:11.3f} ms{hashed[1] * 1e6:13.1f} us')
+    print(f'{"stored digest":18}{stored[0] * 1e3:11.3f} ms{stored[1] * 1e6:13.1f} us')
+    print(f'{"saved per page":18}{(hashed[0] - stored[0]) * 1e3:11.3f} ms{(hashed[1] - stored[1]) * 1e6:13.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Measure login throughput per core for each password hashing method.
+
+Every /auth/login and every HTTP Basic request to /api/tokens verifies one password hash, so
+checks per second bounds the logins a worker can serve. Each method is timed in a single process
+and across a pool of one process per core. Run from the project root:
+
+    python -m benchmarks.password_hashing --methods pbkdf2:sha256:50000 pbkdf2:sha256:150000
+"""
+import argparse
+from multiprocessing import Pool, cpu_count
+from time import perf_counter
+from werkzeug.security import generate_password_hash, check_password_hash
+from config import Config
+
+PASSWORD = 'correct horse battery staple'
+
+
+def check(args):
+    password_hash, checks = args
+    start = perf_counter()
+    for _ in range(checks):
+        check_password_hash(password_hash, PASSWORD)
+    return perf_counter() - start
+
+
+def measure(method, salt_length, checks, processes):
+    password_hash = generate_password_hash(PASSWORD, method=method, salt_length=salt_length)
+    single = checks / check((password_hash, checks))
+    with Pool(processes) as pool:
+        start = perf_counter()
+        pool.map(check, [(password_hash, checks)] * processes)
+        parallel = checks * processes / (perf_counter() - start)
+    return single, parallel
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='+', default=['pbkdf2:sha256:50000', Config.PASSWORD_HASH_METHOD,
+                                                         'pbkdf2:sha256:300000'],
+                        help='werkzeug hashing methods to compare')
+    parser.add_argument('--checks', type=int, default=20, help='password checks per process for each method')
+    parser.add_argument('--processes', type=int, default=cpu_count(), help='processes in the parallel run')
+    args = parser.parse_args()
+
+    print(f'{args.checks} checks per process, {args.processes} processes')
+    print(f'{"method":28}{"ms/login":>10}{"logins/s/core":>15}{"logins/s total":>16}')
+    for method in args.methods:
+        single, parallel = measure(method, Config.PASSWORD_SALT_LENGTH, args.checks, args.processes)
+        print(f'{method:28}{1e3 / single:10.1f}{parallel / args.processes:15.1f}{parallel:16.1f}')
+
+
+if __name__ == '__main__':
+    main()
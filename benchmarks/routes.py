@@ -0,0 +1,264 @@
+"""Load test the hot routes and record latency percentiles, throughput and queries per request.
+
+A synthetic dataset is seeded into a scratch database (see 'flask seed'), then every route is
+requested in turn through the Flask test client, or over HTTP against a local gunicorn when
+--gunicorn is given (gunicorn must be installed). Search is only measured when a search backend
+is configured, see SEARCH_BACKEND. Results can be saved as JSON and compared across commits. Run
+from the project root:
+
+    python -m benchmarks.routes --users 5000 --requests 200 --output before.json
+    python -m benchmarks.routes --gunicorn --workers 4 --concurrency 8
+    python -m benchmarks.routes --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter, sleep
+import requests
+from flask_migrate import upgrade
+from app import create_app, db
+from app.models import User
+from app.seed import SyntheticGraph, import_rows, finish_import
+from config import Config, basedir
+
+PASSWORD = 'password'
+
+# name: (path, who makes the request), paths are formatted with a random user id
+ROUTES = {
+    'index': ('/index', 'session'),
+    'explore': ('/explore', 'session'),
+    'explore_anonymous': ('/explore', 'anonymous'),
+    'user': ('/user/user{id}', 'session'),
+    'search': ('/search?search=post', 'session'),
+    'notifications': ('/notifications?since=0', 'session'),
+    'api_user': ('/api/users/{id}', 'token'),
+    'api_users': ('/api/users?per_page=25', 'token'),
+    'api_users_ids': ('/api/users?ids={ids}', 'token'),
+    'api_followers': ('/api/users/{id}/followers?per_page=25', 'token'),
+}
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def seed(args):
+    graph = SyntheticGraph(args.users, args.posts, args.follows, args.exponent, args.seed)
+    start = perf_counter()
+    for name, rows in [('users', graph.user_rows()), ('posts', graph.post_rows()), ('follows', graph.follow_rows())]:
+        import_rows(name, rows, Config.IMPORT_BATCH_SIZE, PASSWORD, shared_hash=True)
+    finish_import()
+    print(f'Seeded {args.users} users in {perf_counter() - start:.1f}s')
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(latencies, elapsed, queries=None, errors=0):
+    latencies = sorted(latencies)
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'mean_ms': sum(latencies) / len(latencies) * 1e3,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p90_ms': percentile(latencies, 90) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'throughput': len(latencies) / elapsed,
+    }
+    if queries is not None:
+        result['queries_per_request'] = queries / len(latencies)
+    return result
+
+
+def urls(path, users, count, rng):
+    for _ in range(count):
+        ids = ','.join(str(rng.randint(1, users)) for _ in range(25))
+        yield path.format(id=rng.randint(1, users), ids=ids)
+
+
+class LocalDriver(object):
+    """Send the requests through the Flask test client, one at a time, counting SQL statements."""
+
+    def __init__(self, app, username):
+        self.app = app
+        user = User.query.filter_by(username=username).first()
+        self.clients = {'anonymous': app.test_client(), 'session': app.test_client(), 'token': app.test_client()}
+        with self.clients['session'].session_transaction() as session:
+            session['user_id'] = str(user.id)
+            session['_fresh'] = True
+        auth = 'Basic ' + b64encode(f'{username}:{PASSWORD}'.encode('UTF-8')).decode('UTF-8')
+        token = self.clients['token'].post('/api/tokens', headers={'Authorization': auth}).get_json()['token']
+        self.headers = {'token': {'Authorization': 'Bearer ' + token}}
+
+    def run(self, who, urls, concurrency):
+        counter = QueryCounter()
+        db.event.listen(db.engine, 'before_cursor_execute', counter)
+        latencies = []
+        errors = 0
+        start = perf_counter()
+        try:
+            for url in urls:
+                request_start = perf_counter()
+                response = self.clients[who].get(url, headers=self.headers.get(who))
+                latencies.append(perf_counter() - request_start)
+                errors += response.status_code >= 400
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', counter)
+        return summarize(latencies, perf_counter() - start, counter.count, errors)
+
+
+class HTTPDriver(object):
+    """Send the requests over HTTP from a pool of concurrency threads."""
+
+    def __init__(self, base_url, username):
+        self.base_url = base_url
+        self.sessions = {'anonymous': requests.Session(), 'session': requests.Session(), 'token': requests.Session()}
+        login = self.sessions['session'].get(base_url + '/auth/login').text
+        csrf_token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', login)
+        self.sessions['session'].post(base_url + '/auth/login', data={
+            'username': username, 'password': PASSWORD, 'csrf_token': csrf_token.group(1) if csrf_token else ''})
+        token = self.sessions['token'].post(base_url + '/api/tokens', auth=(username, PASSWORD)).json()['token']
+        self.sessions['token'].headers['Authorization'] = 'Bearer ' + token
+
+    def run(self, who, urls, concurrency):
+        session = self.sessions[who]
+
+        def get(url):
+            request_start = perf_counter()
+            response = session.get(self.base_url + url)
+            return perf_counter() - request_start, response.status_code >= 400
+
+        start = perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(get, list(urls)))
+        return summarize([latency for latency, _ in results], perf_counter() - start,
+                         errors=sum(error for _, error in results))
+
+
+def start_gunicorn(database_url, port, workers):
+    env = dict(os.environ, DATABASE_URL=database_url, LOG_TO_STDOUT='1')
+    process = subprocess.Popen(['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', 'microblog:app'],
+                               env=env, cwd=basedir)
+    for _ in range(100):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/explore')
+            return process
+        except requests.ConnectionError:
+            sleep(0.1)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def report(results):
+    print(f'{"route":20}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"req/s":>9}{"queries":>9}{"errors":>8}')
+    for name, result in results.items():
+        queries = result.get('queries_per_request')
+        print(f'{name:20}{result["p50_ms"]:9.2f}{result["p90_ms"]:9.2f}{result["p99_ms"]:9.2f}'
+              f'{result["throughput"]:9.1f}{queries if queries is not None else float("nan"):9.1f}'
+              f'{result["errors"]:8}')
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f'{before.get("commit")} -> {after.get("commit")}')
+    print(f'{"route":20}{"p50":>10}{"p99":>10}{"req/s":>10}{"queries":>10}')
+    for name, result in after['results'].items():
+        if name not in before['results']:
+            continue
+        old = before['results'][name]
+        changes = [f'{(result[key] - old[key]) / old[key] * 100:+9.1f}%' if old.get(key) else f'{"-":>10}'
+                   for key in ['p50_ms', 'p99_ms', 'throughput', 'queries_per_request'] if key in result]
+        print(f'{name:20}' + ''.join(changes))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--posts', type=int, default=20, help='average posts per user')
+    parser.add_argument('--follows', type=int, default=50, help='average accounts followed per user')
+    parser.add_argument('--exponent', type=float, default=1.0, help='power law exponent of the follower distribution')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the data and the requests')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--routes', nargs='+', choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument('--database-url', help='scratch database, a temporary SQLite file by default')
+    parser.add_argument('--gunicorn', action='store_true', help='serve the app with a local gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=8765, help='gunicorn port')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent requests against gunicorn')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two saved results')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    path = None
+    if not args.database_url:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        args.database_url = 'sqlite:///' + path
+    BenchmarkConfig.SQLALCHEMY_DATABASE_URI = args.database_url
+    app = create_app(BenchmarkConfig)
+    server = None
+    try:
+        with app.app_context():
+            upgrade(directory=os.path.join(basedir, 'migrations'))
+            seed(args)
+            # Log in as the user that follows the most accounts, the heaviest home timeline
+            username = User.query.order_by(User.followed_count.desc()).first().username
+            routes = [name for name in args.routes if name != 'search' or app.search]
+            if args.gunicorn:
+                server = start_gunicorn(args.database_url, args.port, args.workers)
+                driver = HTTPDriver(f'http://127.0.0.1:{args.port}', username)
+            else:
+                driver = LocalDriver(app, username)
+            rng = random.Random(args.seed)
+            results = {}
+            for name in routes:
+                route, who = ROUTES[name]
+                driver.run(who, urls(route, args.users, min(10, args.requests), rng), args.concurrency)
+                results[name] = driver.run(who, urls(route, args.users, args.requests, rng), args.concurrency)
+        report(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'commit': git_commit(), 'date': datetime.utcnow().isoformat() + 'Z',
+                           'driver': 'gunicorn' if args.gunicorn else 'test client',
+                           'settings': {key: value for key, value in vars(args).items() if key != 'compare'},
+                           'results': results}, f, indent=2)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        if path:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Seed a large social graph and compare the hot social graph queries before and after the
+followers primary key and the post/message composite indexes (revision 3f1b6c2d8e4a).
+
+Run from the project root:
+
+    python -m benchmarks.social_graph --users 20000 --follows 50 --posts 20
+"""
+import argparse
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+import sqlalchemy as sa
+from flask_migrate import upgrade
+from app import create_app, db
+from config import Config, basedir
+
+BEFORE = '6950cbaa2b9a'
+AFTER = '3f1b6c2d8e4a'
+
+QUERIES = {
+    'is_following': 'SELECT count(*) FROM followers '
+                    'WHERE followers.follower_id = :user_id AND followers.followed_id = :other_id',
+    'followed_count': 'SELECT count(*) FROM followers WHERE followers.follower_id = :user_id',
+    'follower_count': 'SELECT count(*) FROM followers WHERE followers.followed_id = :user_id',
+    'followed_post': 'SELECT id, timestamp FROM ('
+                     'SELECT post.id AS id, post.timestamp AS timestamp FROM post '
+                     'JOIN followers ON followers.followed_id = post.user_id WHERE followers.follower_id = :user_id '
+                     'UNION SELECT post.id AS id, post.timestamp AS timestamp FROM post WHERE post.user_id = :user_id'
+                     ') AS timeline ORDER BY timestamp DESC LIMIT 25',
+    'user_posts': 'SELECT post.id FROM post WHERE post.user_id = :user_id ORDER BY post.timestamp DESC LIMIT 25',
+    'inbox': 'SELECT message.id FROM message WHERE message.recipient_id = :user_id '
+             'ORDER BY message.timestamp DESC LIMIT 25',
+}
+
+user_table = sa.table('user', sa.column('id'), sa.column('username'), sa.column('email'), sa.column('last_seen'))
+post_table = sa.table('post', sa.column('body'), sa.column('timestamp'), sa.column('user_id'))
+message_table = sa.table('message', sa.column('sender_id'), sa.column('recipient_id'), sa.column('body'),
+                         sa.column('timestamp'))
+followers_table = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+
+
+def insert_batches(table, rows, batch_size=10000):
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[start:start + batch_size])
+    db.session.commit()
+
+
+def seed(users, follows, posts, messages):
+    now = datetime.utcnow()
+    insert_batches(user_table, [{'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'last_seen': now}
+                                for i in range(1, users + 1)])
+    edges = set()
+    for follower_id in range(1, users + 1):
+        for followed_id in random.sample(range(1, users + 1), min(follows, users - 1)):
+            if followed_id != follower_id:
+                edges.add((follower_id, followed_id))
+    insert_batches(followers_table, [{'follower_id': a, 'followed_id': b} for a, b in edges])
+    insert_batches(post_table, [{'body': f'post {i}', 'user_id': random.randint(1, users),
+                                 'timestamp': now - timedelta(seconds=i)} for i in range(users * posts)])
+    insert_batches(message_table, [{'sender_id': random.randint(1, users), 'recipient_id': random.randint(1, users),
+                                    'body': f'message {i}', 'timestamp': now - timedelta(seconds=i)}
+                                   for i in range(users * messages)])
+    return len(edges)
+
+
+def explain(sql):
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = db.session.execute(sa.text(prefix + sql), {'user_id': 1, 'other_id': 2}).fetchall()
+    return [' '.join(str(value) for value in row) for row in rows]
+
+
+def measure(users, repeat):
+    results = {}
+    for name, sql in QUERIES.items():
+        statement = sa.text(sql)
+        params = [{'user_id': random.randint(1, users), 'other_id': random.randint(1, users)} for _ in range(repeat)]
+        start = perf_counter()
+        for param in params:
+            db.session.execute(statement, param).fetchall()
+        results[name] = {'ms': (perf_counter() - start) * 1000 / repeat, 'plan': explain(sql)}
+    return results
+
+
+def report(label, results):
+    print(f'\n== {label} ==')
+    for name, result in results.items():
+        print(f'{name:16} {result["ms"]:9.3f} ms')
+        for line in result['plan']:
+            print(f'{"":16}   {line}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50, help='accounts followed per user')
+    parser.add_argument('--posts', type=int, default=20, help='posts per user')
+    parser.add_argument('--messages', type=int, default=5, help='messages per user')
+    parser.add_argument('--repeat', type=int, default=200, help='executions of each query')
+    parser.add_argument('--database-url', help='scratch database, a temporary SQLite file by default')
+    args = parser.parse_args()
+
+    path = None
+    if not args.database_url:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        args.database_url = 'sqlite:///' + path
+    BenchmarkConfig.SQLALCHEMY_DATABASE_URI = args.database_url
+    app = create_app(BenchmarkConfig)
+    directory = os.path.join(basedir, 'migrations')
+    try:
+        with app.app_context():
+            upgrade(directory=directory, revision=BEFORE)
+            start = perf_counter()
+            edges = seed(args.users, args.follows, args.posts, args.messages)
+            print(f'Seeded {args.users} users, {edges} follows, {args.users * args.posts} posts and '
+                  f'{args.users * args.messages} messages in {perf_counter() - start:.1f}s')
+            before = measure(args.users, args.repeat)
+            upgrade(directory=directory, revision=AFTER)
+            db.session.remove()
+            after = measure(args.users, args.repeat)
+        report(f'before ({BEFORE})', before)
+        report(f'after ({AFTER})', after)
+        print('\n== speedup ==')
+        for name in QUERIES:
+            print(f'{name:16} {before[name]["ms"] / after[name]["ms"]:9.1f}x')
+    finally:
+        if path:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
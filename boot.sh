@@ -1,4 +1,6 @@
 #!/bin/sh
 source venv/bin/activate
 flask db upgrade
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
\ No newline at end of file
+# Threaded workers, so that long polls and notification streams do not block other requests
+exec gunicorn -b :5000 -k gthread -w ${WEB_WORKERS:-4} --threads ${WEB_THREADS:-8} \
+    --access-logfile - --error-logfile - microblog:app
@@ -10,8 +10,41 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = 16
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
     POSTS_PER_PAGE = 25
+    CURSOR_PAGINATION = os.environ.get('CURSOR_PAGINATION') is not None
+    PAGINATION_COUNT = True
     LANGUAGES = ['en']
     TRANSLATE_KEY = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+    TRANSLATION_CACHE_SIZE = 10000
+    TRANSLATE_BATCH_SIZE = 100
+    TRANSLATION_CACHE_TTL = 7 * 24 * 3600
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    ELASTICSEARCH_CHUNK_SIZE = 500
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or ('elasticsearch' if ELASTICSEARCH_URL else 'database')
+    REDIS_URL = os.environ.get('REDIS_URL')
+    TASKS_EAGER = os.environ.get('TASKS_EAGER') is not None
+    TASK_RETRIES = 3
+    TASK_RETRY_BACKOFF = 1
+    TIMELINE_BACKEND = os.environ.get('TIMELINE_BACKEND')
+    NOTIFICATIONS_PUSH = os.environ.get('NOTIFICATIONS_PUSH') is not None
+    NOTIFICATIONS_TIMEOUT = 25
+    NOTIFICATIONS_POLL_INTERVAL = 10
+    NOTIFICATIONS_MAX_AGE = 30 * 24 * 3600
+    TOKEN_CACHE_BACKEND = os.environ.get('TOKEN_CACHE_BACKEND') or ('redis' if REDIS_URL else None)
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TTL = 60
+    LAST_SEEN_BACKEND = os.environ.get('LAST_SEEN_BACKEND') or 'memory'
+    LAST_SEEN_THRESHOLD = 60
+    LAST_SEEN_FLUSH_INTERVAL = 30
+    TIMELINE_LENGTH = 800
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND')
+    RESPONSE_CACHE_SIZE = 1000
+    RESPONSE_CACHE_TTL = 30
+    EXPORT_CHUNK_SIZE = 1000
+    IMPORT_BATCH_SIZE = 10000
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION') is not None
+    INSTRUMENTATION_SLOWEST_QUERIES = 3
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 0.5)
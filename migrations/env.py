@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 import logging
+import re
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -71,6 +72,12 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # the full-text index tables of the database search backend, and the
+    # FTS5 shadow tables behind them, are not part of the models
+    def include_object(object, name, type_, reflected, compare_to):
+        return not (type_ == 'table' and reflected and compare_to is None and
+                    re.match(r'\w+_search(_\w+)?$', name))
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section),
         prefix='sqlalchemy.',
@@ -82,6 +89,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,51 @@
+"""social graph indexes
+
+Revision ID: 3f1b6c2d8e4a
+Revises: 6950cbaa2b9a
+Create Date: 2026-10-18 09:12:41.208310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1b6c2d8e4a'
+down_revision = '6950cbaa2b9a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The followers table is rebuilt so that duplicate and incomplete rows can be dropped
+    # before the composite primary key is enforced.
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+    op.create_index('ix_message_recipient_id_timestamp', 'message', ['recipient_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_recipient_id_timestamp', table_name='message')
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) SELECT follower_id, followed_id FROM followers')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
@@ -0,0 +1,40 @@
+"""user counters
+
+Revision ID: 8a41d7e3c925
+Revises: 3f1b6c2d8e4a
+Create Date: 2026-10-18 10:03:17.554920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a41d7e3c925'
+down_revision = '3f1b6c2d8e4a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill the counters from the existing rows
+    user = sa.table('user', sa.column('id'), sa.column('post_count'), sa.column('follower_count'),
+                    sa.column('followed_count'))
+    post = sa.table('post', sa.column('id'), sa.column('user_id'))
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+    op.execute(user.update().values(
+        post_count=sa.select([sa.func.count(post.c.id)]).where(post.c.user_id == user.c.id).as_scalar(),
+        follower_count=sa.select([sa.func.count()]).where(followers.c.followed_id == user.c.id).as_scalar(),
+        followed_count=sa.select([sa.func.count()]).where(followers.c.follower_id == user.c.id).as_scalar(),
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('post_count')
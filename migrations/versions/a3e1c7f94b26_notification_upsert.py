@@ -0,0 +1,66 @@
+"""notification upsert
+
+Revision ID: a3e1c7f94b26
+Revises: f2b6d9c4a853
+Create Date: 2026-10-18 14:12:08.553961
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3e1c7f94b26'
+down_revision = 'f2b6d9c4a853'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('notification_seq', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('notification', sa.Column('seq', sa.Integer(), nullable=True))
+
+    user = sa.table('user', sa.column('id'), sa.column('notification_seq'))
+    notification = sa.table('notification', sa.column('id'), sa.column('user_id'), sa.column('name'),
+                            sa.column('timestamp'), sa.column('seq'))
+    connection = op.get_bind()
+
+    # Keep only the latest row of every (user_id, name)
+    newer = notification.alias('newer')
+    op.execute(notification.delete().where(sa.exists().where(sa.and_(
+        newer.c.user_id == notification.c.user_id,
+        newer.c.name == notification.c.name,
+        sa.or_(newer.c.timestamp > notification.c.timestamp,
+               sa.and_(newer.c.timestamp == notification.c.timestamp, newer.c.id > notification.c.id))
+    ))))
+
+    # Number the remaining rows of each user in timestamp order
+    rows = []
+    last_user_id = None
+    seq = 0
+    for id, user_id in connection.execute(sa.select([notification.c.id, notification.c.user_id])
+                                          .order_by(notification.c.user_id, notification.c.timestamp,
+                                                    notification.c.id)):
+        seq = seq + 1 if user_id == last_user_id else 1
+        last_user_id = user_id
+        rows.append({'notification_id': id, 'number': seq})
+    if rows:
+        connection.execute(notification.update().where(notification.c.id == sa.bindparam('notification_id'))
+                           .values(seq=sa.bindparam('number')), rows)
+    last_seq = sa.select([sa.func.coalesce(sa.func.max(notification.c.seq), 0)])\
+        .where(notification.c.user_id == user.c.id).as_scalar()
+    op.execute(user.update().values(notification_seq=last_seq))
+
+    op.drop_index('ix_notification_name', table_name='notification')
+    op.create_index('ix_notification_user_id_name', 'notification', ['user_id', 'name'], unique=True)
+    op.create_index('ix_notification_user_id_seq', 'notification', ['user_id', 'seq'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notification_user_id_seq', table_name='notification')
+    op.drop_index('ix_notification_user_id_name', table_name='notification')
+    op.create_index('ix_notification_name', 'notification', ['name'], unique=False)
+    with op.batch_alter_table('notification') as batch_op:
+        batch_op.drop_column('seq')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('notification_seq')
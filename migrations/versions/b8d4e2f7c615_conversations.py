@@ -0,0 +1,83 @@
+"""conversations
+
+Revision ID: b8d4e2f7c615
+Revises: a3e1c7f94b26
+Create Date: 2026-10-18 14:58:33.207416
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d4e2f7c615'
+down_revision = 'a3e1c7f94b26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user1_id', sa.Integer(), nullable=True),
+    sa.Column('user2_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['last_message_id'], ['message.id'], name='fk_conversation_last_message_id'),
+    sa.ForeignKeyConstraint(['user1_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user2_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_conversation_user1_id_user2_id', 'conversation', ['user1_id', 'user2_id'], unique=True)
+    op.create_table('participant',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('conversation_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['conversation_id'], ['conversation.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'conversation_id')
+    )
+    op.create_index('ix_participant_user_id_timestamp', 'participant', ['user_id', 'timestamp', 'conversation_id'],
+                    unique=False)
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.add_column(sa.Column('conversation_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_message_conversation_id', 'conversation', ['conversation_id'], ['id'])
+    op.create_index('ix_message_conversation_id_timestamp', 'message', ['conversation_id', 'timestamp'], unique=False)
+
+    # One conversation per pair of users that exchanged messages, pointing at their latest message. Each
+    # step is a single set-based statement so the backfill does not cost round trips per conversation
+    message = sa.table('message', sa.column('id'), sa.column('sender_id'), sa.column('recipient_id'),
+                       sa.column('timestamp'), sa.column('conversation_id'))
+    conversation = sa.table('conversation', sa.column('id'), sa.column('user1_id'), sa.column('user2_id'),
+                            sa.column('last_message_id'), sa.column('timestamp'))
+    participant = sa.table('participant', sa.column('user_id'), sa.column('conversation_id'), sa.column('timestamp'))
+    connection = op.get_bind()
+    user1_id = sa.func.min(message.c.sender_id, message.c.recipient_id) \
+        if connection.dialect.name == 'sqlite' else sa.func.least(message.c.sender_id, message.c.recipient_id)
+    user2_id = sa.func.max(message.c.sender_id, message.c.recipient_id) \
+        if connection.dialect.name == 'sqlite' else sa.func.greatest(message.c.sender_id, message.c.recipient_id)
+    op.execute(conversation.insert().from_select(['user1_id', 'user2_id'],
+                                                 sa.select([user1_id, user2_id]).distinct()))
+    op.execute(message.update().values(conversation_id=sa.select([conversation.c.id]).where(
+        sa.and_(conversation.c.user1_id == user1_id, conversation.c.user2_id == user2_id)).as_scalar()))
+    op.execute(conversation.update().values(last_message_id=sa.select([message.c.id])
+                                            .where(message.c.conversation_id == conversation.c.id)
+                                            .order_by(message.c.timestamp.desc(), message.c.id.desc())
+                                            .limit(1).as_scalar()))
+    op.execute(conversation.update().values(timestamp=sa.select([message.c.timestamp])
+                                            .where(message.c.id == conversation.c.last_message_id).as_scalar()))
+    # Users that wrote to themselves get a single participant row
+    op.execute(participant.insert().from_select(['user_id', 'conversation_id', 'timestamp'], sa.union(
+        sa.select([conversation.c.user1_id, conversation.c.id, conversation.c.timestamp]),
+        sa.select([conversation.c.user2_id, conversation.c.id, conversation.c.timestamp]))))
+
+
+def downgrade():
+    op.drop_index('ix_message_conversation_id_timestamp', table_name='message')
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.drop_constraint('fk_message_conversation_id', type_='foreignkey')
+        batch_op.drop_column('conversation_id')
+    op.drop_index('ix_participant_user_id_timestamp', table_name='participant')
+    op.drop_table('participant')
+    op.drop_index('ix_conversation_user1_id_user2_id', table_name='conversation')
+    op.drop_table('conversation')
@@ -0,0 +1,35 @@
+"""avatar hash
+
+Revision ID: c5e9f0a2b7d1
+Revises: 8a41d7e3c925
+Create Date: 2026-10-18 11:26:05.731842
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e9f0a2b7d1'
+down_revision = '8a41d7e3c925'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('avatar_hash', sa.String(length=32), nullable=True))
+
+    # Backfill the digests, md5 is not available in SQL on every database
+    user = sa.table('user', sa.column('id'), sa.column('email'), sa.column('avatar_hash'))
+    connection = op.get_bind()
+    rows = [{'user_id': id, 'digest': md5(email.lower().encode('UTF-8')).hexdigest()}
+            for id, email in connection.execute(sa.select([user.c.id, user.c.email])) if email]
+    if rows:
+        connection.execute(user.update().where(user.c.id == sa.bindparam('user_id'))
+                           .values(avatar_hash=sa.bindparam('digest')), rows)
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('avatar_hash')
@@ -0,0 +1,31 @@
+"""post search index
+
+Revision ID: c7a9e4d2b318
+Revises: b8d4e2f7c615
+Create Date: 2026-10-18 16:40:27.118302
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a9e4d2b318'
+down_revision = 'b8d4e2f7c615'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE post_search USING fts5(body, tokenize='porter unicode61')")
+        op.execute('INSERT INTO post_search (rowid, body) SELECT id, body FROM post')
+    elif dialect == 'postgresql':
+        op.execute('CREATE TABLE post_search (id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)')
+        op.execute("INSERT INTO post_search (id, document) SELECT id, to_tsvector('english', coalesce(body, '')) FROM post")
+        op.execute('CREATE INDEX ix_post_search_document ON post_search USING gin (document)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE post_search')
@@ -0,0 +1,27 @@
+"""widen password hash
+
+Revision ID: d1f8b3a6e527
+Revises: c7a9e4d2b318
+Create Date: 2026-10-19 09:12:44.301857
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1f8b3a6e527'
+down_revision = 'c7a9e4d2b318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite does not enforce VARCHAR lengths, the table is not worth rebuilding there
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('user', 'password_hash', existing_type=sa.String(length=128), type_=sa.String(length=256))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('user', 'password_hash', existing_type=sa.String(length=256), type_=sa.String(length=128))
@@ -0,0 +1,30 @@
+"""user last modified
+
+Revision ID: d4a7b2e9f610
+Revises: c5e9f0a2b7d1
+Create Date: 2026-10-18 12:02:41.318204
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7b2e9f610'
+down_revision = 'c5e9f0a2b7d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('last_modified', sa.DateTime(), nullable=True))
+
+    # Existing rows count as modified now so that no client gets a 304 for a change made before
+    user = sa.table('user', sa.column('last_modified'))
+    op.execute(user.update().values(last_modified=datetime.utcnow()))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('last_modified')
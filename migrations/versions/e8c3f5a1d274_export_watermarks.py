@@ -0,0 +1,34 @@
+"""export watermarks
+
+Revision ID: e8c3f5a1d274
+Revises: d4a7b2e9f610
+Create Date: 2026-10-18 12:47:19.602415
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c3f5a1d274'
+down_revision = 'd4a7b2e9f610'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('followers', sa.Column('timestamp', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_followers_timestamp'), 'followers', ['timestamp'], unique=False)
+    op.create_index(op.f('ix_user_last_modified'), 'user', ['last_modified'], unique=False)
+
+    # When existing edges were made is unknown, they are exported by the next incremental pull
+    followers = sa.table('followers', sa.column('timestamp'))
+    op.execute(followers.update().values(timestamp=datetime.utcnow()))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_last_modified'), table_name='user')
+    op.drop_index(op.f('ix_followers_timestamp'), table_name='followers')
+    with op.batch_alter_table('followers') as batch_op:
+        batch_op.drop_column('timestamp')
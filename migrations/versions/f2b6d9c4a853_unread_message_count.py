@@ -0,0 +1,34 @@
+"""unread message count
+
+Revision ID: f2b6d9c4a853
+Revises: e8c3f5a1d274
+Create Date: 2026-10-18 13:35:52.144730
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b6d9c4a853'
+down_revision = 'e8c3f5a1d274'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('unread_message_count', sa.Integer(), server_default='0', nullable=False))
+
+    user = sa.table('user', sa.column('id'), sa.column('last_message_read_time'), sa.column('unread_message_count'))
+    message = sa.table('message', sa.column('id'), sa.column('recipient_id'), sa.column('timestamp'))
+    unread = sa.select([sa.func.count(message.c.id)]).where(sa.and_(
+        message.c.recipient_id == user.c.id,
+        message.c.timestamp > sa.func.coalesce(user.c.last_message_read_time, datetime(1900, 1, 1))
+    )).as_scalar()
+    op.execute(user.update().values(unread_message_count=unread))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('unread_message_count')
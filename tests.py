@@ -1,19 +1,110 @@
+import io
+import json
 import unittest
+from contextlib import contextmanager
+from unittest import mock
 from datetime import datetime, timedelta
 from hashlib import md5
-from app import db, create_app
-from app.models import User, Post
+from base64 import b64encode, urlsafe_b64encode
+from rq.job import Job
+from app import db, create_app, cli, translate
+from app.models import User, Post, Message, Notification, Conversation
+from app.tasks import task, update_unread_message_count
+from app.pubsub import MemoryBroker
+from app.activity import record_activity, flush_activity
+from app.timeline import timeline_page, push_post, add_followed, remove_followed
+from app.pagination import keyset_paginate, encode_cursor, decode_cursor
+from app.seed import SyntheticGraph, read_rows, import_rows, finish_import
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
 
 
-class UserModelCase(unittest.TestCase):
+class TimelineConfig(TestConfig):
+    TIMELINE_BACKEND = 'memory'
+
+
+class TokenCacheConfig(TestConfig):
+    TOKEN_CACHE_BACKEND = 'memory'
+
+
+class ResponseCacheConfig(TestConfig):
+    RESPONSE_CACHE_BACKEND = 'memory'
+
+
+class ElasticsearchConfig(TestConfig):
+    SEARCH_BACKEND = 'elasticsearch'
+
+
+class FakeElasticsearch(object):
+    """In-process stand-in for the parts of the Elasticsearch client used by app.search."""
+
+    def __init__(self):
+        self.indices = {}
+        self.requests = []
+
+    def index(self, index, id, body):
+        self.requests.append('index')
+        self.indices.setdefault(index, {})[str(id)] = body
+
+    def delete(self, index, id):
+        self.requests.append('delete')
+        self.indices.get(index, {}).pop(str(id), None)
+
+    def bulk(self, body):
+        self.requests.append('bulk')
+        items = []
+        body = iter(body)
+        for action in body:
+            op, meta = list(action.items())[0]
+            if op == 'index':
+                self.indices.setdefault(meta['_index'], {})[str(meta['_id'])] = next(body)
+            else:
+                self.indices.get(meta['_index'], {}).pop(str(meta['_id']), None)
+            items.append({op: {'_id': meta['_id'], 'status': 200}})
+        return {'errors': False, 'items': items}
+
+    def search(self, index, body):
+        self.requests.append('search')
+        words = body['query']['multi_match']['query'].lower().split()
+        hits = [{'_id': id} for id, document in sorted(self.indices.get(index, {}).items())
+                if any(word in str(value).lower() for word in words for value in document.values())]
+        page = hits[body['from']:body['from'] + body['size']]
+        return {'hits': {'hits': page, 'total': {'value': len(hits)}}}
+
+
+class QueryCounter(object):
+    """Counts the SQL statements sent to the database."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+@contextmanager
+def query_budget(test, budget):
+    """Fail the test if the block runs more than budget SQL statements."""
+    counter = QueryCounter()
+    db.event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', counter)
+    test.assertLessEqual(len(counter.statements), budget, '\n\n'.join(counter.statements))
+
+
+class AppTestCase(unittest.TestCase):
+    """Runs every test in an app context with a fresh in-memory database."""
+    config = TestConfig
+
     def setUp(self):
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.config)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -23,6 +114,8 @@ class UserModelCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+
+class UserModelCase(AppTestCase):
     def test_password_hashing(self):
         nayan = User(username='nayan')
         nayan.set_password('zaveri')
@@ -36,6 +129,13 @@ class UserModelCase(unittest.TestCase):
         nayan_avatar = f'http://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
         self.assertEqual(nayan.avatar(size), nayan_avatar)
 
+    def test_avatar_hash(self):
+        nayan = User(username='nayan', email='Nayan@CrazyIdeas.co.in')
+        self.assertEqual(nayan.avatar_hash, md5(b'nayan@crazyideas.co.in').hexdigest())
+        nayan.email = 'nayan@example.com'
+        self.assertEqual(nayan.avatar_hash, md5(b'nayan@example.com').hexdigest())
+        self.assertIn(nayan.avatar_hash, nayan.avatar(64))
+
     def test_follow(self):
         # Create two users
         nayan = User(username='nayan', email='nayan@crazyideas.co.in')
@@ -114,6 +214,883 @@ class UserModelCase(unittest.TestCase):
         raj_wall = raj.followed_post().all()
         self.assertEqual(raj_wall, [raj_post])
 
+    def test_counters(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        db.session.add_all([nayan, nisha])
+        db.session.add_all([Post(author=nisha, body='First post'), Post(author=nisha, body='Second post')])
+        nayan.follow(nisha)
+        db.session.commit()
+        self.assertEqual(nisha.post_count, 2)
+        self.assertEqual(nisha.follower_count, 1)
+        self.assertEqual(nayan.followed_count, 1)
+        with self.app.test_request_context():
+            self.assertEqual(nayan.to_dict()['followed_count'], 1)
+
+        db.session.delete(nisha.posts.first())
+        nayan.unfollow(nisha)
+        db.session.commit()
+        self.assertEqual((nisha.post_count, nisha.follower_count, nayan.followed_count), (1, 0, 0))
+
+        # Several follows before a flush each count, and a repeated follow does not
+        raj = User(username='raj', email='raj@crazyideas.co.in')
+        nayan.follow(nisha)
+        nayan.follow(raj)
+        nayan.follow(raj)
+        db.session.commit()
+        self.assertEqual((nayan.followed_count, nisha.follower_count, raj.follower_count), (2, 1, 1))
+        nayan.unfollow(nisha)
+        nayan.unfollow(raj)
+        db.session.commit()
+
+        # Drift is detected and repaired
+        nisha.post_count = 10
+        nayan.followed_count = 3
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(), 2)
+        db.session.commit()
+        self.assertEqual((nisha.post_count, nayan.followed_count), (1, 0))
+
+    def test_unread_message_count(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nayan.set_password('zaveri')
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        db.session.add_all([nayan, nisha, Message(author=nisha, recipient=nayan, body='Hello'),
+                            Message(author=nisha, recipient=nayan, body='Are you there?')])
+        db.session.commit()
+        self.assertEqual(nayan.unread_message_count, 2)
+
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'nayan', 'password': 'zaveri'})
+        with query_budget(self, 10) as counter:
+            page = client.get('/explore').get_data(as_text=True)
+        self.assertFalse([statement for statement in counter.statements if 'FROM message' in statement])
+        self.assertIn('visibility:  visible', page)
+        client.get('/messages')
+        db.session.expire_all()
+        self.assertEqual(nayan.unread_message_count, 0)
+
+        nayan.unread_message_count = 5
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(), 1)
+        db.session.commit()
+        self.assertEqual(nayan.unread_message_count, 0)
+
+    def test_last_seen_coalescing(self):
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        long_ago = datetime.utcnow() - timedelta(hours=1)
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in', last_seen=long_ago)
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in', last_seen=datetime.utcnow())
+        db.session.add_all([nayan, nisha])
+        db.session.commit()
+
+        # Only the stale value is buffered and nothing is written yet
+        record_activity(nayan)
+        record_activity(nisha)
+        self.assertEqual(nayan.last_seen, long_ago)
+        self.assertGreater(nayan.get_last_seen(), long_ago)
+        self.assertIsNone(self.app.activity.get(nisha.id))
+
+        self.assertEqual(flush_activity(), 1)
+        db.session.expire_all()
+        self.assertGreater(nayan.last_seen, long_ago)
+        self.assertEqual(flush_activity(), 0)
+
+    def test_last_seen_flush_failure(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        db.session.add(nayan)
+        db.session.commit()
+        when = datetime.utcnow()
+        self.app.activity.record(nayan.id, when)
+        with mock.patch.object(db.session, 'commit', side_effect=RuntimeError('database is down')):
+            with self.assertRaises(RuntimeError):
+                flush_activity()
+        # The failed batch is kept for the next flush
+        self.assertEqual(self.app.activity.get(nayan.id), when)
+        self.assertEqual(flush_activity(), 1)
+        db.session.expire_all()
+        self.assertEqual(nayan.last_seen, when)
+
+    def test_last_seen_redis_backend_needs_redis(self):
+        class RedisActivityConfig(TestConfig):
+            LAST_SEEN_BACKEND = 'redis'
+            REDIS_URL = None
+        with self.assertRaises(RuntimeError):
+            create_app(RedisActivityConfig)
+
+    def test_keyset_pagination(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        db.session.add_all([nayan, nisha])
+        now = datetime.utcnow()
+        # Two posts share a timestamp so the id has to break the tie
+        posts = [Post(author=nisha, body=f'Post {i}', timestamp=now + timedelta(seconds=i // 2)) for i in range(5)]
+        db.session.add_all(posts)
+        nayan.follow(nisha)
+        db.session.commit()
+        expected = nayan.followed_post().order_by(None).order_by(Post.timestamp.desc(), Post.id.desc()).all()
+
+        # Walk forward through the UNION query two posts at a time
+        first = keyset_paginate(nayan.followed_post(), Post, 2, count=True)
+        self.assertEqual(first.items, expected[:2])
+        self.assertEqual(first.total, 5)
+        self.assertFalse(first.has_prev)
+        second = keyset_paginate(nayan.followed_post(), Post, 2, after=decode_cursor(first.next_cursor))
+        self.assertEqual(second.items, expected[2:4])
+        self.assertIsNone(second.total)
+        third = keyset_paginate(nayan.followed_post(), Post, 2, after=decode_cursor(second.next_cursor))
+        self.assertEqual(third.items, expected[4:])
+        self.assertFalse(third.has_next)
+
+        # And back again
+        back = keyset_paginate(nayan.followed_post(), Post, 2, before=decode_cursor(third.prev_cursor))
+        self.assertEqual(back.items, expected[2:4])
+        self.assertTrue(back.has_prev)
+        self.assertEqual(decode_cursor(encode_cursor([now, 3])), [now, 3])
+
+
+class TimelineCase(AppTestCase):
+    config = TimelineConfig
+
+    def test_timeline_fan_out(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        raj = User(username='raj', email='raj@crazyideas.co.in')
+        db.session.add_all([nayan, nisha, raj])
+        now = datetime.utcnow()
+        nisha_post = Post(author=nisha, body='Post from nisha', timestamp=now + timedelta(seconds=2))
+        nayan_post = Post(author=nayan, body='Post from nayan', timestamp=now + timedelta(seconds=1))
+        db.session.add_all([nisha_post, nayan_post])
+        nayan.follow(nisha)
+        db.session.commit()
+
+        # The first read materializes the timeline from the database
+        self.assertEqual(timeline_page(nayan, 10, page=1).items, [nisha_post, nayan_post])
+
+        # New posts are pushed to the timelines of the followers
+        raj_post = Post(author=raj, body='Post from raj', timestamp=now + timedelta(seconds=3))
+        db.session.add(raj_post)
+        nayan.follow(raj)
+        db.session.commit()
+        add_followed(nayan, raj)
+        nisha_post_2 = Post(author=nisha, body='Another post from nisha', timestamp=now + timedelta(seconds=4))
+        db.session.add(nisha_post_2)
+        db.session.commit()
+        push_post(nisha_post_2)
+        posts = timeline_page(nayan, 10, page=1)
+        self.assertEqual(posts.items, [nisha_post_2, raj_post, nisha_post, nayan_post])
+        self.assertEqual(posts.items, nayan.followed_post().all())
+
+        # Unfollow removes the posts and pages are served from the store
+        nayan.unfollow(nisha)
+        db.session.commit()
+        remove_followed(nayan, nisha)
+        posts = timeline_page(nayan, 1, page=2)
+        self.assertEqual(posts.total, 2)
+        self.assertEqual(posts.items, [nayan_post])
+        self.assertFalse(posts.has_next)
+
+    def test_unfollow_full_timeline(self):
+        self.app.config['TIMELINE_LENGTH'] = 3
+        now = datetime.utcnow()
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        raj = User(username='raj', email='raj@crazyideas.co.in')
+        raj_posts = [Post(author=raj, body=f'Post {i} from raj', timestamp=now + timedelta(seconds=i)) for i in range(4)]
+        nisha_posts = [Post(author=nisha, body=f'Post {i} from nisha', timestamp=now + timedelta(seconds=10 + i))
+                       for i in range(3)]
+        db.session.add_all([nayan] + raj_posts + nisha_posts)
+        nayan.follow(nisha)
+        nayan.follow(raj)
+        db.session.commit()
+        self.assertEqual(timeline_page(nayan, 2, page=1).items, nisha_posts[:0:-1])
+
+        nayan.unfollow(nisha)
+        db.session.commit()
+        remove_followed(nayan, nisha)
+        self.assertEqual(timeline_page(nayan, 2, page=1).items, raj_posts[:1:-1])
+        # The timeline is full again, so the page past its end comes from the database
+        self.assertIsNone(timeline_page(nayan, 2, page=2))
+        self.assertEqual(nayan.followed_post().all(), raj_posts[::-1])
+
+    def test_full_timeline_last_page(self):
+        self.app.config['TIMELINE_LENGTH'] = 4
+        now = datetime.utcnow()
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        posts = [Post(author=nisha, body=f'Post {i} from nisha', timestamp=now + timedelta(seconds=i)) for i in range(5)]
+        db.session.add_all([nayan] + posts)
+        nayan.follow(nisha)
+        db.session.commit()
+        first = timeline_page(nayan, 2, page=1)
+        self.assertEqual(first.items, posts[:2:-1])
+        self.assertTrue(first.has_next)
+        # The store is full and its last page ends exactly at the end of the store, so the database
+        # answers it and still finds the older post
+        self.assertIsNone(timeline_page(nayan, 2, page=2))
+        second = nayan.followed_post().paginate(2, 2, False)
+        self.assertEqual(second.items, posts[2:0:-1])
+        self.assertTrue(second.has_next)
+
+    def test_redis_backend_needs_redis(self):
+        class RedisTimelineConfig(TestConfig):
+            TIMELINE_BACKEND = 'redis'
+            REDIS_URL = None
+        with self.assertRaises(RuntimeError):
+            create_app(RedisTimelineConfig)
+
+    def test_timeline_fallback(self):
+        self.app.timeline = None
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        db.session.add(nayan)
+        db.session.commit()
+        self.assertIsNone(timeline_page(nayan, 10, page=1))
+
+
+class SearchCase(AppTestCase):
+    config = ElasticsearchConfig
+
+    def setUp(self):
+        super().setUp()
+        self.app.elasticsearch = FakeElasticsearch()
+
+    def test_bulk_indexing(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        posts = [Post(author=nayan, body=f'Post number {i}') for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        # One commit of five posts is one bulk request
+        self.assertEqual(self.app.elasticsearch.requests, ['bulk'])
+        self.assertEqual(len(self.app.elasticsearch.indices['post']), 5)
+
+        db.session.delete(posts[0])
+        db.session.commit()
+        self.assertEqual(len(self.app.elasticsearch.indices['post']), 4)
+
+        query, total = Post.search('number', 1, 3)
+        self.assertEqual(total, 4)
+        self.assertEqual(query.all(), posts[1:4])
+
+    def test_reindex(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        db.session.add_all([Post(author=nayan, body=f'Post number {i}') for i in range(5)])
+        db.session.commit()
+        self.app.elasticsearch = FakeElasticsearch()
+        reports = []
+        count = Post.reindex(chunk_size=2, progress=lambda indexed, elapsed: reports.append(indexed))
+        self.assertEqual(count, 5)
+        self.assertEqual(reports, [2, 4, 5])
+        self.assertEqual(self.app.elasticsearch.requests, ['bulk'] * 3)
+        self.assertEqual(len(self.app.elasticsearch.indices['post']), 5)
+
+
+class DatabaseSearchCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_search(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        posts = [Post(author=nayan, body=f'Post number {i}') for i in range(5)]
+        other = Post(author=nayan, body='Numbers, "numbers" OR number')
+        db.session.add_all(posts + [other])
+        db.session.commit()
+
+        # Stemmed, ranked, newest first on ties and paginated
+        query, total = Post.search('numbers', 1, 3)
+        self.assertEqual(total, 6)
+        self.assertEqual(query.all(), [other, posts[4], posts[3]])
+        query, total = Post.search('post number', 2, 3)
+        self.assertEqual((query.all(), total), (posts[1::-1], 5))
+        self.assertEqual(Post.search('post', 3, 3)[1], 5)
+        # Query syntax in the search terms is matched literally
+        self.assertEqual(Post.search('"numbers" OR', 1, 3)[0].all(), [other])
+        self.assertEqual(Post.search('  ', 1, 3)[1], 0)
+
+        # The index follows edits and deletes, and is rolled back with the rows
+        posts[0].body = 'Edited'
+        db.session.delete(posts[1])
+        db.session.commit()
+        self.assertEqual(Post.search('number', 1, 10)[0].all(), [other, posts[4], posts[3], posts[2]])
+        self.assertEqual(Post.search('edited', 1, 10)[0].all(), [posts[0]])
+        db.session.add(Post(author=nayan, body='Never committed'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(Post.search('committed', 1, 10)[1], 0)
+
+    def test_search_route(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nayan.set_password('zaveri')
+        db.session.add_all([nayan] + [Post(author=nayan, body=f'Post number {i}') for i in range(30)])
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'nayan', 'password': 'zaveri'})
+        page = client.get('/search?search=number').get_data(as_text=True)
+        self.assertIn('Post number 29', page)
+        self.assertNotIn('id="post5"', page)
+        self.assertIn('/search?search=number&amp;page=2', page)
+        self.assertIn('id="post5"', client.get('/search?search=number&page=2').get_data(as_text=True))
+
+
+class NotificationCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['NOTIFICATIONS_TIMEOUT'] = 0.2
+        self.app.config['NOTIFICATIONS_PUSH'] = True
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_broker(self):
+        broker = MemoryBroker()
+        subscription = broker.subscribe('channel')
+        broker.publish('channel', {'name': 'one'})
+        broker.publish('other', {'name': 'two'})
+        self.assertEqual(list(subscription.listen(0.1)), [{'name': 'one'}])
+        subscription.close()
+        self.assertEqual(broker.subscriptions, {})
+
+    def test_publish_on_commit(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        db.session.add(nayan)
+        db.session.commit()
+        subscription = self.app.notification_broker.subscribe(Notification.channel(nayan.id))
+        nayan.add_notification('unread_message_count', 3)
+        self.assertEqual(list(subscription.listen(0)), [])
+        db.session.commit()
+        messages = list(subscription.listen(0.1))
+        self.assertEqual([(m['name'], m['data']) for m in messages], [('unread_message_count', 3)])
+        # Rolled back notifications are never published
+        nayan.add_notification('unread_message_count', 4)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(list(subscription.listen(0.1)), [])
+        subscription.close()
+
+    def test_notification_stream(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nayan.set_password('zaveri')
+        db.session.add(nayan)
+        nayan.add_notification('unread_message_count', 2)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'nayan', 'password': 'zaveri'})
+        response = client.get('/notifications/stream')
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = [line for line in response.get_data(as_text=True).split('\n') if line.startswith('data: ')]
+        self.assertEqual(len(events), 1)
+        self.assertIn('"unread_message_count"', events[0])
+
+        # Long polling waits for the next notification when there is nothing new
+        since = nayan.notifications.first().seq
+        response = client.get(f'/notifications?wait=1&since={since}')
+        self.assertEqual(response.get_json(), [])
+
+        # Without push the stream is off and the page polls without waiting
+        self.app.config['NOTIFICATIONS_PUSH'] = False
+        self.assertEqual(client.get('/notifications/stream').status_code, 404)
+        self.assertNotIn('EventSource', client.get('/index').get_data(as_text=True))
+
+    def test_upsert(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        db.session.add(nayan)
+        db.session.commit()
+        self.assertEqual([nayan.add_notification('unread_message_count', n) for n in range(3)], [1, 2, 3])
+        self.assertEqual(nayan.add_notification('task_progress', 50), 4)
+        db.session.commit()
+        self.assertEqual(nayan.notifications.count(), 2)
+        self.assertEqual(nayan.notifications_since(2), [{'name': 'unread_message_count', 'data': 2, 'seq': 3},
+                                                        {'name': 'task_progress', 'data': 50, 'seq': 4}])
+        self.assertEqual(nayan.notifications_since(4), [])
+
+        Notification.query.filter_by(name='task_progress').update({'timestamp': 0})
+        self.assertEqual(Notification.expire(3600), 1)
+        db.session.commit()
+        # Sequence numbers keep growing after notifications expire
+        self.assertEqual(nayan.add_notification('task_progress', 75), 5)
+
+    def test_upsert_without_on_conflict(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        db.session.add(nayan)
+        db.session.commit()
+        with mock.patch('app.models.sqlite3.sqlite_version_info', (3, 23, 0)):
+            nayan.add_notification('unread_message_count', 1)
+            nayan.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(nayan.notifications_since(0), [{'name': 'unread_message_count', 'data': 2, 'seq': 2}])
+
+
+class ConversationCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app.config['POSTS_PER_PAGE'] = 2
+        self.users = [User(username=name, email=f'{name}@crazyideas.co.in') for name in ['nayan', 'nisha', 'rohan']]
+        self.users[0].set_password('zaveri')
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'nayan', 'password': 'zaveri'})
+
+    def test_conversations(self):
+        nayan, nisha, rohan = self.users
+        db.session.add_all([Message(author=nisha, recipient=nayan, body='one'),
+                            Message(author=rohan, recipient=nayan, body='two')])
+        db.session.commit()
+        self.client.post('/send_message/nisha', data={'message': 'three'})
+        conversation = Conversation.between(nisha, nayan)
+        self.assertEqual(conversation.last_message.body, 'three')
+        self.assertEqual(conversation.messages.count(), 2)
+        self.assertEqual(Conversation.query.count(), 2)
+
+        # Resetting the unread counter and its notification take six statements, the inbox page one plus its count
+        with query_budget(self, 8) as counter:
+            page = self.client.get('/messages').get_data(as_text=True)
+        self.assertEqual(len([statement for statement in counter.statements if 'FROM participant' in statement]), 2)
+        self.assertLess(page.index('three'), page.index('two'))
+
+        for body in ['four', 'five']:
+            self.client.post('/send_message/nisha', data={'message': body})
+        thread = self.client.get('/messages/nisha').get_data(as_text=True)
+        self.assertIn('five', thread)
+        self.assertNotIn('three', thread)
+        self.assertIn('three', self.client.get('/messages/nisha?page=2').get_data(as_text=True))
+        self.assertNotIn('two', self.client.get('/messages/nisha?page=2').get_data(as_text=True))
+
+    def test_concurrent_first_message(self):
+        nayan, nisha, _ = self.users
+        db.session.add(Message(author=nisha, recipient=nayan, body='one'))
+        db.session.commit()
+        conversation = Conversation.between(nisha, nayan)
+        # The lookup misses as if the other first message was committed right after it
+        find = Conversation.find
+        misses = [None]
+        with mock.patch.object(Conversation, 'find', side_effect=lambda *args: misses.pop() if misses else find(*args)):
+            message = Message(author=nayan, recipient=nisha, body='two')
+            db.session.add(message)
+            db.session.commit()
+        self.assertEqual(message.conversation_id, conversation.id)
+        self.assertEqual(Conversation.query.count(), 1)
+        self.assertEqual(conversation.last_message, message)
+
+
+class QueryBudgetCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        # A page of posts from as many different authors
+        per_page = self.app.config['POSTS_PER_PAGE']
+        self.users = [User(username=f'user{i}', email=f'user{i}@crazyideas.co.in') for i in range(per_page)]
+        self.users[0].set_password('zaveri')
+        db.session.add_all(self.users)
+        db.session.add_all([Post(author=user, body=f'Post from {user.username}') for user in self.users])
+        db.session.commit()
+        for user in self.users[1:]:
+            self.users[0].follow(user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'user0', 'password': 'zaveri'})
+
+    def test_feed_query_budget(self):
+        for url in ['/index', '/explore', '/user/user24', '/search?search=post']:
+            with query_budget(self, 6):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('user24', response.get_data(as_text=True), url)
+
+
+class ResponseCacheCase(AppTestCase):
+    config = ResponseCacheConfig
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        self.nayan.set_password('zaveri')
+        db.session.add(self.nayan)
+        db.session.add(Post(author=self.nayan, body='first post'))
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def test_anonymous_pages(self):
+        for url in ['/explore', '/user/nayan', '/user/nayan/popup']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            with query_budget(self, 0):
+                cached = self.client.get(url)
+            self.assertEqual(cached.get_data(), response.get_data())
+            self.assertEqual(cached.headers['ETag'], response.headers['ETag'])
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code,
+                             304)
+
+    def test_invalidation(self):
+        etag = self.client.get('/explore').headers['ETag']
+        self.client.get('/user/nayan')
+        member = self.app.test_client()
+        member.post('/auth/login', data={'username': 'nayan', 'password': 'zaveri'})
+        member.post('/index', data={'post': 'second post'})
+        response = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('second post', response.get_data(as_text=True))
+        self.assertIn('second post', self.client.get('/user/nayan').get_data(as_text=True))
+
+        member.post('/edit_profile', data={'username': 'nayan', 'about_me': 'hello there'})
+        self.assertIn('hello there', self.client.get('/user/nayan/popup').get_data(as_text=True))
+
+
+class InstrumentationConfig(TestConfig):
+    INSTRUMENTATION = True
+
+
+class InstrumentationCase(AppTestCase):
+    config = InstrumentationConfig
+
+    def setUp(self):
+        super().setUp()
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        db.session.add_all([nayan, Post(author=nayan, body='first post')])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def test_server_timing(self):
+        with self.assertLogs(self.app.logger, 'INFO') as logs:
+            response = self.client.get('/user/nayan')
+        metrics = [metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(metrics, ['total', 'db', 'template'])
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['endpoint'], 'main.user')
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['template_ms'], 0)
+        self.assertNotIn('all_queries', record)
+
+    def test_slow_request(self):
+        self.app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/explore')
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(len(record['all_queries']), record['queries'])
+
+    def test_failed_query(self):
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            connection = db.session.connection()
+            with self.assertRaises(Exception):
+                db.session.execute('SELECT * FROM no_such_table')
+            self.assertEqual(connection.info.get('query_start'), [])
+            db.session.rollback()
+
+
+class TokenCacheCase(AppTestCase):
+    config = TokenCacheConfig
+
+    def setUp(self):
+        super().setUp()
+        self.nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        self.nayan.set_password('zaveri')
+        self.nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        db.session.add_all([self.nayan, self.nisha])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def get_token(self):
+        auth = 'Basic ' + b64encode(b'nayan:zaveri').decode('UTF-8')
+        return self.client.post('/api/tokens', headers={'Authorization': auth}).get_json()['token']
+
+    def test_cached_token(self):
+        headers = {'Authorization': 'Bearer ' + self.get_token()}
+        # Only the requested user is loaded, authentication comes from the cache
+        with query_budget(self, 1):
+            response = self.client.get(f'/api/users/{self.nisha.id}', headers=headers)
+        self.assertEqual(response.get_json()['username'], 'nisha')
+
+        self.assertEqual(self.client.delete('/api/tokens', headers=headers).status_code, 204)
+        self.assertEqual(self.client.get(f'/api/users/{self.nisha.id}', headers=headers).status_code, 401)
+
+    def test_expired_token(self):
+        token = self.get_token()
+        self.nayan.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.app.token_cache.set(token, self.nayan.id, self.nayan.token_expiration)
+        response = self.client.get(f'/api/users/{self.nisha.id}', headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 401)
+        self.assertIsNone(self.app.token_cache.get(token))
+
+    def test_password_rehash(self):
+        self.assertTrue(self.nayan.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        # A successful login upgrades the stored hash to the configured method
+        self.get_token()
+        db.session.expire_all()
+        self.assertTrue(self.nayan.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(self.nayan.check_password('zaveri'))
+        self.assertFalse(self.nayan.password_needs_rehash())
+
+    def test_no_token_cache(self):
+        self.app.token_cache = None
+        headers = {'Authorization': 'Bearer ' + self.get_token()}
+        self.assertEqual(self.client.get(f'/api/users/{self.nisha.id}', headers=headers).status_code, 200)
+        self.assertEqual(self.client.delete('/api/tokens', headers=headers).status_code, 204)
+        self.assertEqual(self.client.get(f'/api/users/{self.nisha.id}', headers=headers).status_code, 401)
+
+    def test_redis_backend_needs_redis(self):
+        class RedisTokenConfig(TestConfig):
+            TOKEN_CACHE_BACKEND = 'redis'
+            REDIS_URL = None
+        with self.assertRaises(RuntimeError):
+            create_app(RedisTokenConfig)
+
+    def test_password_policy(self):
+        User.validate_password_policy('pbkdf2:sha512:600000', 16)
+        for method, salt_length in [('bogus', 16), ('pbkdf2:sha256:many', 16), ('pbkdf2:sha512:1000', 200)]:
+            with self.assertRaises(ValueError):
+                User.validate_password_policy(method, salt_length)
+
+
+class APICase(AppTestCase):
+    config = TokenCacheConfig
+
+    def setUp(self):
+        super().setUp()
+        self.nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        self.nayan.set_password('zaveri')
+        self.nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        db.session.add_all([self.nayan, self.nisha])
+        db.session.commit()
+        self.client = self.app.test_client()
+        auth = 'Basic ' + b64encode(b'nayan:zaveri').decode('UTF-8')
+        token = self.client.post('/api/tokens', headers={'Authorization': auth}).get_json()['token']
+        self.headers = {'Authorization': 'Bearer ' + token}
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=dict(self.headers, **headers))
+
+    def test_user(self):
+        url = f'/api/users/{self.nisha.id}'
+        response = self.get(url)
+        etag = response.headers['ETag']
+        self.assertEqual(self.get(url, **{'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(self.get(url, **{'If-Modified-Since': response.headers['Last-Modified']}).status_code, 304)
+
+        self.nayan.follow(self.nisha)
+        db.session.commit()
+        response = self.get(url, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['follower_count'], 1)
+
+    def test_invalid_cursor(self):
+        def cursor(values):
+            return urlsafe_b64encode(json.dumps(values).encode('UTF-8')).decode('UTF-8')
+
+        self.assertEqual(self.client.get('/explore?after=' + cursor([{'a': 1}, 1])).status_code, 400)
+        self.assertEqual(self.client.get('/explore?before=' + cursor([None, None])).status_code, 400)
+        self.assertEqual(self.client.get('/explore?after=' + cursor([{'$date': '2019-05-01T10:00:00'}, True])).status_code, 400)
+        self.assertEqual(self.client.get('/explore?after=' + cursor([{'$date': '2019-05-01T10:00:00'}, 1])).status_code, 200)
+        self.assertEqual(self.get('/api/users?after=' + cursor([[1]])).status_code, 400)
+        self.assertEqual(self.get('/api/users?after=' + cursor([2 ** 64])).status_code, 400)
+        self.assertEqual(self.get('/api/users?after=' + cursor([1])).status_code, 200)
+
+    def test_collections(self):
+        for url in ['/api/users', f'/api/users/{self.nisha.id}/followers']:
+            etag = self.get(url).headers['ETag']
+            self.assertEqual(self.get(url, **{'If-None-Match': etag}).status_code, 304)
+            self.nayan.follow(self.nisha)
+            db.session.commit()
+            self.assertEqual(self.get(url, **{'If-None-Match': etag}).status_code, 200)
+            self.nayan.unfollow(self.nisha)
+            db.session.commit()
+
+    def test_bulk_lookup(self):
+        url = f'/api/users?ids={self.nisha.id},999,{self.nayan.id}&fields=username,follower_count'
+        with query_budget(self, 1):
+            response = self.get(url)
+        self.assertEqual(response.get_json()['items'], [
+            {'id': self.nisha.id, 'username': 'nisha', 'follower_count': 0},
+            {'id': self.nayan.id, 'username': 'nayan', 'follower_count': 0},
+        ])
+        self.assertEqual(self.get('/api/users?ids=1,x').status_code, 400)
+        self.assertEqual(self.get(f'/api/users/{self.nisha.id}?fields=password_hash').status_code, 400)
+        links = self.get('/api/users?per_page=1&fields=username').get_json()['_links']
+        self.assertIn('fields=username', links['next'])
+
+    def test_export(self):
+        db.session.add_all([Post(author=self.nayan, body=f'post {i}') for i in range(3)])
+        self.nayan.follow(self.nisha)
+        db.session.commit()
+        response = self.get('/api/export/posts')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        posts = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([post['body'] for post in posts], ['post 0', 'post 1', 'post 2'])
+        # The watermark of the last row is inclusive
+        since = posts[-1]['timestamp']
+        posts = self.get(f'/api/export/posts?since={since}').get_data(as_text=True).splitlines()
+        self.assertEqual(json.loads(posts[-1])['body'], 'post 2')
+        follows = self.get('/api/export/follows').get_data(as_text=True).splitlines()
+        self.assertEqual(json.loads(follows[0])['followed_id'], self.nisha.id)
+        self.assertEqual(self.get('/api/export/users?since=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/api/export/users').status_code, 401)
+
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['export', 'users'])
+        self.assertEqual([json.loads(line)['username'] for line in result.output.splitlines()], ['nayan', 'nisha'])
+
+
+class SeedCase(AppTestCase):
+    def test_seed(self):
+        graph = SyntheticGraph(users=50, posts=3, follows=5, seed=1)
+        for name, rows in [('users', graph.user_rows()), ('posts', graph.post_rows()), ('follows', graph.follow_rows())]:
+            import_rows(name, rows, batch_size=20, password='zaveri', shared_hash=True)
+        finish_import()
+        users = User.query.all()
+        self.assertEqual(len(users), 50)
+        self.assertEqual(sum(user.post_count for user in users), Post.query.count())
+        self.assertEqual(sum(user.follower_count for user in users), sum(user.followed_count for user in users))
+        self.assertTrue(users[0].check_password('zaveri'))
+        self.assertEqual(Post.search('post', 1, 10)[1], Post.query.count())
+
+    def test_import_csv(self):
+        users = io.StringIO('id,username,email\n7,nayan,nayan@crazyideas.co.in\n8,nisha,\n')
+        posts = io.StringIO('user_id,body,timestamp\n7,first post,2026-01-01T10:00:00Z\n')
+        import_rows('users', read_rows(users, 'csv'), batch_size=10, password='zaveri')
+        import_rows('posts', read_rows(posts, 'csv'), batch_size=10)
+        finish_import(index=False)
+        nayan = User.query.get(7)
+        self.assertEqual(nayan.avatar_hash, User.email_hash('nayan@crazyideas.co.in'))
+        self.assertEqual(nayan.post_count, 1)
+        self.assertEqual(nayan.posts.first().timestamp, datetime(2026, 1, 1, 10))
+        self.assertIsNone(User.query.get(8).email)
+        # Imported users do not share salts
+        self.assertTrue(nayan.check_password('zaveri'))
+        self.assertNotEqual(nayan.password_hash, User.query.get(8).password_hash)
+
+
+class FakeTranslateClient(object):
+    def __init__(self):
+        self.calls = 0
+
+    def translate(self, values, target_language=None, source_language=None):
+        self.calls += 1
+        return [{'translatedText': f'[{target_language}] {value}'} for value in values]
+
+
+class TranslateCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['TRANSLATE_KEY'] = 'key'
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.client = FakeTranslateClient()
+        translate._client = self.client
+
+    def tearDown(self):
+        translate._client = None
+        super().tearDown()
+
+    def test_translation_cache(self):
+        self.assertEqual(translate.translate_post('Hola', 'en', 'es'), '[en] Hola')
+        self.assertEqual(translate.translate_post('Hola', 'en', 'es'), '[en] Hola')
+        self.assertEqual(self.client.calls, 1)
+        # A different target language is a different entry
+        self.assertEqual(translate.translate_post('Hola', 'fr', 'es'), '[fr] Hola')
+        self.assertEqual(self.client.calls, 2)
+        stats = self.app.translation_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 2, 2))
+
+    def test_translate_batch(self):
+        translate.translate_post('Hola', 'en', 'es')
+        results = translate.translate_batch(['Hola', 'Adios', 'Gracias'], 'en', 'es')
+        self.assertEqual(results, ['[en] Hola', '[en] Adios', '[en] Gracias'])
+        # The cached text is reused and the other two go out in one request
+        self.assertEqual(self.client.calls, 2)
+
+    def test_translate_batch_route(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nayan.set_password('zaveri')
+        posts = [Post(author=nayan, body='Hola', language='es'), Post(author=nayan, body='Bonjour', language='fr'),
+                 Post(author=nayan, body='Adios', language='es')]
+        db.session.add_all(posts)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'nayan', 'password': 'zaveri'})
+        response = client.post('/translate/batch', json={'post_ids': [post.id for post in posts], 'to_language': 'en'})
+        translations = response.get_json()['translations']
+        self.assertEqual(translations, {str(post.id): f'[en] {post.body}' for post in posts})
+        # One request per source language
+        self.assertEqual(self.client.calls, 2)
+        for data in [{'post_ids': 1, 'to_language': 'en'}, {'post_ids': {'1': 1}, 'to_language': 'en'},
+                     {'post_ids': ['1'], 'to_language': 'en'}, {'post_ids': [1], 'to_language': ['en']},
+                     {'post_ids': [1]}, [1]]:
+            self.assertEqual(client.post('/translate/batch', json=data).status_code, 400, data)
+        # A batch larger than TRANSLATE_BATCH_SIZE is refused instead of truncated
+        self.app.config['TRANSLATE_BATCH_SIZE'] = 2
+        response = client.post('/translate/batch', json={'post_ids': [post.id for post in posts], 'to_language': 'en'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.calls, 2)
+
+    def test_translation_job_owner(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nayan.set_password('zaveri')
+        db.session.add(nayan)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'nayan', 'password': 'zaveri'})
+        job = mock.Mock(meta={'user_id': nayan.id}, is_finished=True, result='Hello')
+        with mock.patch.object(Job, 'fetch', return_value=job):
+            self.assertEqual(client.get('/translate/job').get_json(), {'text': 'Hello'})
+            # Someone else's job is not found
+            job.meta['user_id'] = nayan.id + 1
+            self.assertEqual(client.get('/translate/job').status_code, 404)
+
+    def test_translation_cache_eviction(self):
+        cache = translate.TranslationCache(maxsize=2, ttl=60)
+        for text in ['one', 'two', 'three']:
+            cache.set(cache.key(text, 'es', 'en'), text.upper())
+        self.assertIsNone(cache.get(cache.key('one', 'es', 'en')))
+        self.assertEqual(cache.get(cache.key('three', 'es', 'en')), 'THREE')
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, f, *args, **kwargs):
+        self.jobs.append((f, args, kwargs))
+
+
+class TaskCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['TASK_RETRY_BACKOFF'] = 0
+
+    def test_eager_task(self):
+        nayan = User(username='nayan', email='nayan@crazyideas.co.in')
+        nisha = User(username='nisha', email='nisha@crazyideas.co.in')
+        db.session.add_all([nayan, nisha, Message(author=nisha, recipient=nayan, body='Hello')])
+        db.session.commit()
+        update_unread_message_count.delay(nayan.id)
+        self.assertEqual(nayan.notifications.first().get_data(), 1)
+
+    def test_queued_task(self):
+        self.app.task_queue = FakeQueue()
+        update_unread_message_count.delay(1)
+        f, args, kwargs = self.app.task_queue.jobs[0]
+        self.assertIs(f, update_unread_message_count)
+        self.assertEqual(args, (1,))
+
+    def test_task_retry(self):
+        calls = []
+
+        @task
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ValueError('try again')
+            return 'done'
+
+        # The worker runs the task itself, which retries with backoff
+        self.assertEqual(flaky(), 'done')
+        self.assertEqual(len(calls), 3)
+        calls.clear()
+        self.app.config['TASK_RETRIES'] = 1
+        self.assertRaises(ValueError, flaky)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,11 @@
+from rq import Worker
+from app import create_app
+
+app = create_app()
+app.app_context().push()
+
+
+if __name__ == '__main__':
+    if app.task_queue is None:
+        raise RuntimeError('REDIS_URL is not configured')
+    Worker([app.task_queue], connection=app.redis).work()